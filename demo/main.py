@@ -2,8 +2,10 @@
 from fastapi import FastAPI, Query, HTTPException, Request, Form
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
-from model import create_temp_fa, model_details, embed, predict, convert
+from fastapi.responses import HTMLResponse, PlainTextResponse
+from model import get_engine, get_registry, predict_task, predict_tasks
+from workers import get_pool, PoolSaturated, RETRY_AFTER
+import metrics
 
 app = FastAPI()
 
@@ -12,6 +14,22 @@ staticfiles = StaticFiles(directory="./static")
 app.mount("/static", staticfiles, name="static")
 templates = Jinja2Templates(directory="templates")
 
+# Load the embedding models and classifiers once, when the application starts,
+# process workers load their own copies
+@app.on_event("startup")
+def load_models():
+    if get_pool().kind == 'thread':
+        get_engine()
+        get_registry()
+
+# Run a function on the worker pool, answer 503 when the pool is saturated
+async def run_in_pool(fn, *args):
+    try:
+        return await get_pool().run(fn, *args)
+    except PoolSaturated:
+        raise HTTPException(status_code=503, detail="Server busy, try again later",
+                            headers={'Retry-After': str(RETRY_AFTER)})
+
 # root endpoint
 @app.get('/')
 def root():
@@ -23,28 +41,22 @@ def form_post(request: Request):
     return templates.TemplateResponse('index.html', context={'request': request})
 
 @app.post("/predict", response_class=HTMLResponse, status_code=200)
-def get_prediction(request:Request, task: str = Form(...), protein: str = Form(...)):
-
-    # Create temporary fasta file
-    path_fa = create_temp_fa(protein)
-
-    # Get model details
-    pt_model, pool, model_file = model_details(task)
-
-    # Embed the protein
-    embedding = embed(path_fa, pt_model, pool)
-
-    # Predict the protein
-    prediction = predict(embedding, model_file)
+async def get_prediction(request:Request, task: str = Form(...), protein: str = Form(...)):
 
     # Tasks description dictionary
     tasks_d = {}
     tasks_d['acp'] = 'Anticancer Peptides (ACP)'
     tasks_d['amp'] = 'Antimicrobial Peptides (AMP)'
     tasks_d['dbp'] = 'DNA-Binding Proteins (DBP)'
+    tasks_d['all'] = 'All Tasks (ACP, AMP, DBP)'
 
-    # Get prediction
-    prediction = convert(prediction, task)
+    if task == 'all':
+        # Embed once per pretrained model and run every classifier
+        predictions = await run_in_pool(predict_tasks, protein, ['acp', 'amp', 'dbp'])
+        prediction = ', '.join(predictions.values())
+    else:
+        # Embed and predict the protein
+        prediction = await run_in_pool(predict_task, task, protein)
 
     # Prepare context dictionary
     task = tasks_d[task]
@@ -58,4 +70,8 @@ def get_prediction(request:Request, task: str = Form(...), protein: str = Form(.
         'text1':text1
         }
     # Send the context dictionary to the Jinja template
-    return templates.TemplateResponse('index.html', context=context)
\ No newline at end of file
+    return templates.TemplateResponse('index.html', context=context)
+# /metrics endpoint, stage latencies and service counters in Prometheus text format
+@app.get('/metrics', response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
@@ -0,0 +1,209 @@
+# Minimal Prometheus instrumentation for the prediction service
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Upper bounds of the sequence length buckets used as a label
+LENGTH_BUCKETS = (50, 100, 250, 500, 1000, 2500)
+
+# Label value for the length of a sequence
+def length_bucket(n):
+    for bound in LENGTH_BUCKETS:
+        if n <= bound:
+            return f"le{bound}"
+    return f"gt{LENGTH_BUCKETS[-1]}"
+
+# Format a label set, e.g. {stage="embed",task="acp"}
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+class Metric:
+    """ Base class holding one value per label set
+
+    Args:
+        name: metric name
+        help: description shown in the exposition
+        kind: prometheus metric type
+    """
+    def __init__(self, name, help, kind):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(labels)} {value}")
+        return lines
+
+class Counter(Metric):
+    def __init__(self, name, help):
+        super().__init__(name, help, 'counter')
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    # Add counts drained from another process
+    def merge(self, values):
+        with self.lock:
+            for key, value in values.items():
+                self.values[key] = self.values.get(key, 0) + value
+
+class CallbackMetric(Metric):
+    """ Metric read from a function at scrape time, the function returns a
+    number or a list of (labels dict, number) pairs
+    """
+    def __init__(self, name, help, kind, fn):
+        super().__init__(name, help, kind)
+        self.fn = fn
+
+    # Current (labels dict, number) pairs
+    def samples(self):
+        values = self.fn()
+        if not isinstance(values, list):
+            values = [({}, values)]
+        return values
+
+    def render(self):
+        lines = self.header()
+        for labels, value in self.samples():
+            lines.append(f"{self.name}{format_labels(sorted(labels.items()))} {value}")
+        return lines
+
+class WorkerMetric(Metric):
+    """ Callback metric of the worker processes, keeps the latest samples
+    reported by every worker and exposes their sum
+    """
+    def update(self, pid, samples):
+        with self.lock:
+            self.values[pid] = samples
+
+    def render(self):
+        lines = self.header()
+        totals = {}
+        with self.lock:
+            for samples in self.values.values():
+                for labels, value in samples:
+                    key = tuple(sorted(labels.items()))
+                    totals[key] = totals.get(key, 0) + value
+        for labels, value in sorted(totals.items()):
+            lines.append(f"{self.name}{format_labels(labels)} {value}")
+        return lines
+
+class Histogram(Metric):
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, 'histogram')
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0]*len(self.buckets), 0, 0]
+            counts, _, _ = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key][1] += value
+            self.values[key][2] += 1
+
+    # Time the enclosed block
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    # Add observations drained from another process
+    def merge(self, values):
+        with self.lock:
+            for key, (counts, total, count) in values.items():
+                if key not in self.values:
+                    self.values[key] = [[0]*len(self.buckets), 0, 0]
+                mine = self.values[key]
+                mine[0] = [a + b for a, b in zip(mine[0], counts)]
+                mine[1] += total
+                mine[2] += count
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            for labels, (counts, total, count) in sorted(self.values.items()):
+                for bound, n in zip(self.buckets, counts):
+                    le = format_labels(labels + (('le', bound),))
+                    lines.append(f"{self.name}_bucket{le} {n}")
+                le = format_labels(labels + (('le', '+Inf'),))
+                lines.append(f"{self.name}_bucket{le} {count}")
+                lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+# Metrics of this process, by name
+_metrics = {}
+
+def register(metric):
+    _metrics[metric.name] = metric
+    return metric
+
+# Prometheus text exposition of all metrics
+def render():
+    lines = []
+    for metric in _metrics.values():
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+# Take what this worker process recorded since the last drain: the counter
+# and histogram values, which are reset, and the current callback samples
+def drain():
+    values = {}
+    samples = {}
+    for name, metric in list(_metrics.items()):
+        if isinstance(metric, (Counter, Histogram)):
+            with metric.lock:
+                if metric.values:
+                    values[name] = metric.values
+                    metric.values = {}
+        elif isinstance(metric, CallbackMetric):
+            samples[name] = (metric.help, metric.kind, metric.samples())
+    return os.getpid(), values, samples
+
+# Add what a worker process drained to the metrics of this process
+def merge(drained):
+    pid, values, samples = drained
+    for name, value in values.items():
+        if name in _metrics:
+            _metrics[name].merge(value)
+    for name, (help, kind, value) in samples.items():
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = register(WorkerMetric(name, help, kind))
+        if isinstance(metric, WorkerMetric):
+            metric.update(pid, value)
+
+# Metrics recorded by the prediction path
+STAGE_SECONDS = register(Histogram('protein_stage_seconds',
+    'Latency of the prediction stages by task, pretrained model and sequence length'))
+PREDICTIONS = register(Counter('protein_predictions_total',
+    'Predicted proteins by task'))
+BATCH_SIZE = register(Histogram('protein_batch_size',
+    'Sequences per packed forward pass by pretrained model', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)))
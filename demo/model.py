@@ -1,60 +1,497 @@
 # Import dependencies
 from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import Future
+import hashlib
 import joblib
-import os
 import numpy as np
-import h5py
-import subprocess
+import os
+import queue
+import sys
+import threading
+import time
+import warnings
+from typing import NamedTuple
 
 BASE_DIR = Path(__file__).resolve(strict=True).parent
 
-# Create fasta file
-def create_temp_fa(embedding):
-    path_fa = Path(BASE_DIR).joinpath("temp_fa.fa")
-    Seq = {}
-    Seq['header'] = embedding
-    with open(path_fa, 'w') as fout:
-        for header, sequence in Seq.items():
-            fout.write(f">{header}\n{sequence}\n")
-    return path_fa
-
-# Get model details
-def model_details(task):
-    models_dir = Path(BASE_DIR.parent).joinpath('saved_models/best_models')
-    for file in os.listdir(models_dir):
-        if file.startswith(task):
-            model_name  = file
-
-    model_file = Path(BASE_DIR).joinpath(models_dir, model_name)
-    pool = model_name.split('_')[2]
-    pt_model =  f"prose_{model_name.split('_')[1]}"
-    return pt_model, pool, model_file
-
-# Compute embeddings
-def embed(path_fa, pt_model, pool):
-    path_h5 = Path(BASE_DIR).joinpath(f"temp_h5.h5")
-    subprocess.run(["python", "../prose/embed_sequences.py", "--model", f"{pt_model}", "--pool", f"{pool}", "-o", f"{path_h5}", f"{path_fa}"], check=True)
-
-   # Read embeddings from h5 file    
-    with h5py.File(path_h5, 'r') as hf:
-        for key in hf.keys():
-            X = np.array(hf.get(key)).reshape(1, -1)  
-    # Remove the temporary files
-    path_fa.unlink()   
-    path_h5.unlink()   
-    return X
-
-# Load saved model and predict on new data
-def predict(X, model_file):
-    if not model_file.exists():
-        return False
-    model = joblib.load(model_file)  
-    prediction = model.predict(X)
-    return prediction
+# Make the ProSE repository importable, it sits next to the application
+PROSE_DIR = BASE_DIR.parent.joinpath('prose')
+if str(PROSE_DIR) not in sys.path:
+    sys.path.insert(0, str(PROSE_DIR))
+
+from embed_sequences import embed_buffer, length_batches, window_for_memory
+import prose.fasta as fasta
+import metrics
+from metrics import STAGE_SECONDS, PREDICTIONS, BATCH_SIZE, length_bucket
+
+# Micro-batching of concurrent requests
+BATCH_MAX_WAIT_MS = float(os.environ.get('BATCH_MAX_WAIT_MS', 10))
+BATCH_MAX_TOKENS = int(os.environ.get('BATCH_MAX_TOKENS', 16384))
+
+# Memory ceiling for embedding one sequence, longer sequences are embedded in
+# overlapping windows that fit
+EMBED_MAX_MEMORY_MB = float(os.environ.get('EMBED_MAX_MEMORY_MB', 1024))
+EMBED_OVERLAP = int(os.environ.get('EMBED_OVERLAP', 100))
+
+# Embedding cache, the on-disk tier is enabled by setting a directory
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 4096))
+CACHE_DIR = os.environ.get('CACHE_DIR')
+
+# Batch predictions, sequences are read and answered in chunks of this size
+BATCH_CHUNK_SIZE = int(os.environ.get('BATCH_CHUNK_SIZE', 256))
+
+# Saved classifiers, checked for changes at most every MODELS_CHECK_INTERVAL seconds
+MODELS_DIR = os.environ.get('MODELS_DIR', BASE_DIR.parent.joinpath('saved_models/best_models'))
+MODELS_CHECK_INTERVAL = float(os.environ.get('MODELS_CHECK_INTERVAL', 5))
+
+class ModelSpec(NamedTuple):
+    """ Manifest entry of a saved classifier named <task>_<dlm|mt>_<pool>_<clf>.sav """
+    task: str
+    pt_model: str
+    pool: str
+    clf: str
+    path: Path
+
+# Parse the classifier file name into a manifest entry, None if the name
+# doesn't follow the convention
+def parse_model_name(path):
+    path = Path(path)
+    parts = path.stem.split('_')
+    if len(parts) != 4 or parts[1] not in ('dlm', 'mt'):
+        return None
+    task, pt_model, pool, clf = parts
+    return ModelSpec(task, f"prose_{pt_model}", pool, clf, path)
+
+class ModelRegistry:
+    """ Indexes the saved classifiers once and keeps every pipeline resident.
+    A file is unpickled again only when its modification time changes.
+
+    Args:
+        models_dir: folder with the saved classifiers
+        check_interval: seconds between modification time checks of a file,
+                        a negative value disables reloading
+    """
+    def __init__(self, models_dir=MODELS_DIR, check_interval=MODELS_CHECK_INTERVAL):
+        self.models_dir = Path(models_dir)
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.specs = {}
+        self.models = {}
+        self.mtimes = {}
+        self.checked = {}
+        for file in sorted(os.listdir(self.models_dir)):
+            if file.endswith('.sav'):
+                spec = parse_model_name(self.models_dir.joinpath(file))
+                if spec is None:
+                    warnings.warn(f"Skipping {file}, saved classifiers are named <task>_<dlm|mt>_<pool>_<clf>.sav")
+                    continue
+                self.specs[spec.task] = spec
+        for task in self.specs:
+            self._load(task)
+
+    # Unpickle the classifier, keeping only the refitted pipeline of a grid search
+    def _load(self, task):
+        spec = self.specs[task]
+        mtime = os.stat(spec.path).st_mtime
+        model = joblib.load(spec.path)
+        model = getattr(model, 'best_estimator_', model)
+        self.models[task] = model
+        self.mtimes[task] = mtime
+        self.checked[task] = time.monotonic()
+
+    # Get model details
+    def details(self, task):
+        spec = self.specs[task]
+        return spec.pt_model, spec.pool, spec.path
+
+    def get(self, task):
+        if self.check_interval >= 0:
+            now = time.monotonic()
+            if now - self.checked[task] >= self.check_interval:
+                with self.lock:
+                    self.checked[task] = now
+                    if os.stat(self.specs[task].path).st_mtime != self.mtimes[task]:
+                        self._load(task)
+        return self.models[task]
+
+    # Predict on new data with the resident model
+    def predict(self, task, X):
+        return self.get(task).predict(X)
+
+# Load a pre-trained ProSE model in eval mode
+def load_pretrained(pt_model):
+    if pt_model == 'prose_mt':
+        from prose.models.multitask import ProSEMT
+        model = ProSEMT.load_pretrained()
+    elif pt_model == 'prose_dlm':
+        from prose.models.lstm import SkipLSTM
+        model = SkipLSTM.load_pretrained()
+    else:
+        raise ValueError(f"Unknown pretrained model: {pt_model}")
+    model.eval()
+    return model
+
+# Normalize a protein string the same way the fasta parser does
+def normalize(sequence):
+    if isinstance(sequence, str):
+        sequence = sequence.encode('utf-8')
+    return b''.join(sequence.split()).upper()
+
+class EmbeddingEngine:
+    """ Keeps the pre-trained ProSE models resident in memory and embeds
+    sequences in-process, without temporary files or child processes.
+
+    Args:
+        pt_models: pretrained models to load - ['prose_mt', 'prose_dlm']
+        max_memory_mb: memory ceiling for embedding one sequence
+        overlap: residues shared by the windows of sequences over the ceiling
+    """
+    def __init__(self, pt_models=('prose_mt', 'prose_dlm'), max_memory_mb=EMBED_MAX_MEMORY_MB, overlap=EMBED_OVERLAP):
+        self.models = {}
+        for pt_model in pt_models:
+            self.models[pt_model] = load_pretrained(pt_model)
+        self.max_memory = max_memory_mb*2**20
+        self.overlap = overlap
+        # One forward pass at a time, each one uses all of torch's intra-op threads
+        self.forward_lock = threading.Lock()
+        # Optional BatchScheduler that concurrent requests are funnelled into
+        self.scheduler = None
+        # Optional EmbeddingCache consulted before running the model
+        self.cache = None
+
+    # Compute the pooled embedding of one sequence
+    def embed(self, sequence, model, pool):
+        if self.cache is not None:
+            z = self.cache.get(sequence, model, pool)
+            if z is not None:
+                return z
+
+        if self.scheduler is not None:
+            z = self.scheduler.embed(sequence, model, pool)
+        else:
+            z = self.embed_batch([sequence], model, pool)[0]
+
+        if self.cache is not None:
+            self.cache.put(sequence, model, pool, z)
+        return z
+
+    # Compute the pooled embeddings of several sequences as one packed batch,
+    # with a list of pools each result is a dict keyed by pool. Sequences over
+    # the memory ceiling are embedded on their own, in windows
+    def embed_batch(self, sequences, model, pool):
+        xs = [normalize(sequence) for sequence in sequences]
+        labels = {'task': '', 'model': model, 'length': length_bucket(max(len(x) for x in xs))}
+        BATCH_SIZE.observe(len(xs), model=model)
+        window = window_for_memory(self.models[model], self.max_memory)
+        chunking = (window, min(self.overlap, window//2), self.max_memory)
+        records = list(enumerate(xs))
+        with self.forward_lock:
+            with STAGE_SECONDS.time(stage='forward', **labels):
+                zs = [z for _, z in embed_buffer(self.models[model], records, pool, False, len(xs), None, chunking)]
+        if isinstance(pool, (list, tuple)):
+            return [{p: z[p].reshape(1, -1) for p in pool} for z in zs]
+        return [z.reshape(1, -1) for z in zs]
+
+    # Embed many sequences, taking what we can from the cache and running the
+    # rest as length-sorted packed batches of at most max_tokens residues.
+    # Every pooling in pools comes from one forward pass, each sequence gets
+    # a dict keyed by pool
+    def embed_pools(self, sequences, model, pools, max_tokens=BATCH_MAX_TOKENS):
+        pools = list(pools)
+        zs = [None]*len(sequences)
+        missing = []
+        for i in range(len(sequences)):
+            if self.cache is not None:
+                z = {}
+                for pool in pools:
+                    z[pool] = self.cache.get(sequences[i], model, pool)
+                    if z[pool] is None:
+                        break
+                else:
+                    zs[i] = z
+            if zs[i] is None:
+                missing.append(i)
+
+        lengths = [len(normalize(sequences[i])) for i in missing]
+        for batch in length_batches(lengths, max_tokens=max_tokens):
+            batch = [missing[j] for j in batch]
+            embeddings = self.embed_batch([sequences[i] for i in batch], model, pools)
+            for i, z in zip(batch, embeddings):
+                zs[i] = z
+                if self.cache is not None:
+                    for pool in pools:
+                        self.cache.put(sequences[i], model, pool, z[pool])
+        return zs
+
+class EmbeddingCache:
+    """ Content-addressed cache of pooled embeddings keyed on
+    (sequence hash, pretrained model, pool). A bounded in-memory LRU tier
+    sits in front of an optional on-disk tier that survives restarts.
+
+    Args:
+        max_entries: number of embeddings kept in memory
+        cache_dir: directory of the on-disk tier, None keeps the cache in memory only
+    """
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, cache_dir=CACHE_DIR):
+        self.max_entries = max_entries
+        self.cache_dir = None
+        if cache_dir:
+            self.cache_dir = Path(cache_dir)
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Counters
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(sequence, model, pool):
+        digest = hashlib.sha256(normalize(sequence)).hexdigest()
+        return f"{model}_{pool}_{digest}"
+
+    # Return the cached embedding or None
+    def get(self, sequence, model, pool):
+        key = self.key(sequence, model, pool)
+        with self.lock:
+            z = self.entries.get(key)
+            if z is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return z
+
+        if self.cache_dir is not None:
+            path = self.cache_dir.joinpath(f"{key}.npy")
+            if path.exists():
+                z = np.load(path)
+                with self.lock:
+                    self._insert(key, z)
+                    self.hits += 1
+                    self.disk_hits += 1
+                return z
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, sequence, model, pool, z):
+        key = self.key(sequence, model, pool)
+        with self.lock:
+            self._insert(key, z)
+
+        if self.cache_dir is not None:
+            # Write under a private name first, so readers never see a partial file
+            path = self.cache_dir.joinpath(f"{key}.npy")
+            tmp = self.cache_dir.joinpath(f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp, 'wb') as f:
+                np.save(f, z)
+            os.replace(tmp, path)
+
+    # Add an entry and evict the least recently used ones, lock must be held
+    def _insert(self, key, z):
+        self.entries[key] = z
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                }
+
+class BatchScheduler:
+    """ Collects embedding requests that arrive within a short window and
+    runs each (pt_model, pool) group through the model as one packed batch.
+    Every caller gets back only its own embedding.
+
+    Args:
+        engine: EmbeddingEngine computing the batches
+        max_wait_ms: how long the first request of a batch waits for others
+        max_batch_tokens: maximum number of residues collected into one batch
+    """
+    def __init__(self, engine, max_wait_ms=BATCH_MAX_WAIT_MS, max_batch_tokens=BATCH_MAX_TOKENS):
+        self.engine = engine
+        self.max_wait = max_wait_ms/1000
+        self.max_batch_tokens = max_batch_tokens
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='batch-scheduler', daemon=True)
+        self.thread.start()
+
+    # Queue a sequence, the future resolves to its pooled embedding
+    def submit(self, sequence, model, pool):
+        future = Future()
+        self.queue.put((normalize(sequence), model, pool, future))
+        return future
+
+    def embed(self, sequence, model, pool):
+        return self.submit(sequence, model, pool).result()
+
+    # Block for the first request, then gather more until the window closes
+    # or the batch holds enough residues
+    def _collect(self):
+        item = self.queue.get()
+        items = [item]
+        tokens = len(item[0])
+        deadline = time.monotonic() + self.max_wait
+        while tokens < self.max_batch_tokens:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            items.append(item)
+            tokens += len(item[0])
+        return items
+
+    def _run(self):
+        while True:
+            items = self._collect()
+            # Group the requests by pretrained model and pooling
+            groups = {}
+            for item in items:
+                groups.setdefault((item[1], item[2]), []).append(item)
+            for (model, pool), group in groups.items():
+                xs = [item[0] for item in group]
+                try:
+                    zs = self.engine.embed_batch(xs, model, pool)
+                except Exception as e:
+                    for item in group:
+                        item[3].set_exception(e)
+                    continue
+                for item, z in zip(group, zs):
+                    item[3].set_result(z)
+
+# Engine shared by all requests of this process
+_engine = None
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        _engine = EmbeddingEngine()
+        _engine.scheduler = BatchScheduler(_engine)
+        _engine.cache = EmbeddingCache()
+        register_engine_metrics(_engine)
+    return _engine
+
+# Export the cache counters and the scheduler queue depth
+def register_engine_metrics(engine):
+    def cache_events():
+        stats = engine.cache.stats()
+        return [({'event': event}, stats[event]) for event in ['hits', 'disk_hits', 'misses', 'evictions']]
+    metrics.register(metrics.CallbackMetric('protein_cache_events_total',
+        'Embedding cache lookups and evictions', 'counter', cache_events))
+    metrics.register(metrics.CallbackMetric('protein_cache_entries',
+        'Embeddings held in memory by the cache', 'gauge', lambda: engine.cache.stats()['entries']))
+    metrics.register(metrics.CallbackMetric('protein_batch_queue_depth',
+        'Sequences waiting for the batch scheduler', 'gauge', lambda: engine.scheduler.queue.qsize()))
+
+# Classifiers shared by all requests of this process
+_registry = None
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        _registry = ModelRegistry()
+    return _registry
+
+# Read (id, sequence) records from a binary fasta file object
+def read_fasta(f):
+    for name, sequence in fasta.parse_stream(f):
+        yield name.decode('utf-8'), sequence.decode('utf-8')
+
+# Map every pretrained model needed by the tasks to the poolings it must produce
+def group_tasks(tasks):
+    registry = get_registry()
+    groups = {}
+    for task in tasks:
+        pt_model, pool, _ = registry.details(task)
+        pools = groups.setdefault(pt_model, [])
+        if pool not in pools:
+            pools.append(pool)
+    return groups
+
+# Predict one protein for one task
+def predict_task(task, protein):
+    registry = get_registry()
+    start = time.perf_counter()
+    pt_model, pool, _ = registry.details(task)
+    labels = {'task': task, 'model': f"{pt_model}_{pool}", 'length': length_bucket(len(normalize(protein)))}
+    STAGE_SECONDS.observe(time.perf_counter() - start, stage='model_details', **labels)
+
+    with STAGE_SECONDS.time(stage='embed', **labels):
+        embedding = get_engine().embed(protein, pt_model, pool)
+    with STAGE_SECONDS.time(stage='predict', **labels):
+        prediction = registry.predict(task, embedding)
+    PREDICTIONS.inc(task=task)
+    return convert(prediction, task)
+
+# Predict one protein for several tasks, embedding it once per pretrained model
+def predict_tasks(protein, tasks):
+    result = next(predict_batch([('protein', protein)], tasks))
+    return result['predictions']
+
+# Split records into lists of at most chunk_size
+def chunk_records(records, chunk_size=BATCH_CHUNK_SIZE):
+    records = iter(records)
+    while True:
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                break
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+# Predict a list of (id, sequence) records as one chunk, the picklable unit
+# of work a pool worker runs for batch predictions and jobs
+def predict_records(records, tasks):
+    return list(predict_batch(records, tasks, chunk_size=max(1, len(records))))
+
+# Predict (id, sequence) records for several tasks, a chunk at a time, so
+# memory stays bounded however many records there are
+def predict_batch(records, tasks, chunk_size=BATCH_CHUNK_SIZE):
+    engine = get_engine()
+    registry = get_registry()
+    for chunk in chunk_records(records, chunk_size):
+        sequences = [sequence for _, sequence in chunk]
+        length = length_bucket(max(len(normalize(sequence)) for sequence in sequences))
+        predictions = {}
+        # One forward pass per pretrained model, shared by all of its tasks
+        for pt_model, pools in group_tasks(tasks).items():
+            labels = {'task': 'batch', 'model': pt_model, 'length': length}
+            with STAGE_SECONDS.time(stage='embed', **labels):
+                embeddings = engine.embed_pools(sequences, pt_model, pools)
+            for task in tasks:
+                task_model, pool, _ = registry.details(task)
+                if task_model != pt_model:
+                    continue
+                X = np.concatenate([z[pool] for z in embeddings], 0)
+                labels = {'task': task, 'model': f"{pt_model}_{pool}", 'length': length}
+                with STAGE_SECONDS.time(stage='predict', **labels):
+                    predictions[task] = registry.predict(task, X)
+                PREDICTIONS.inc(len(chunk), task=task)
+
+        for i, (name, sequence) in enumerate(chunk):
+            yield {
+                'id': name,
+                'protein': sequence,
+                'predictions': {task: convert(predictions[task][i], task) for task in tasks},
+                }
 
 # Output a dictionary of prediction
 def convert(prediction, task):
     if prediction == 0:
         return f"non-{task.upper()}"
-    else: 
+    else:
         return f"{task.upper()}"
@@ -0,0 +1,124 @@
+# Bounded pool of CPU workers the async request handlers hand their work to
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import metrics
+
+# Worker pool configuration
+WORKER_KIND = os.environ.get('WORKER_KIND', 'thread')
+WORKERS = int(os.environ.get('WORKERS', os.cpu_count() or 1))
+WORKER_QUEUE = int(os.environ.get('WORKER_QUEUE', 64))
+RETRY_AFTER = int(os.environ.get('RETRY_AFTER', 1))
+
+class PoolSaturated(Exception):
+    """ Raised when every worker is busy and the queue is full """
+
+# Runs once in every worker process
+def init_worker(threads):
+    import torch
+    from model import get_engine, get_registry
+    # Pin the intra-op threads so the workers share the cores instead of
+    # each spreading over all of them
+    torch.set_num_threads(threads)
+    get_engine()
+    get_registry()
+
+# Runs in a worker process, returns the result of fn(*args) together with
+# the metrics recorded since the previous call, for the parent to merge
+def call_with_metrics(fn, *args):
+    return fn(*args), metrics.drain()
+
+class WorkerPool:
+    """ Runs embedding and classification off the event loop on a pool of
+    threads or processes, with a bounded number of queued calls.
+
+    Args:
+        kind: 'thread' to share this process' models, 'process' to give
+              every worker its own models and torch threads
+        workers: number of workers
+        max_queue: calls allowed to wait for a worker before rejecting new ones
+    """
+    def __init__(self, kind=WORKER_KIND, workers=WORKERS, max_queue=WORKER_QUEUE):
+        self.kind = kind
+        self.workers = workers
+        self.max_queue = max_queue
+        if kind == 'process':
+            threads = max(1, (os.cpu_count() or 1)//workers)
+            context = multiprocessing.get_context('spawn')
+            self.executor = ProcessPoolExecutor(workers, mp_context=context,
+                                                initializer=init_worker, initargs=(threads,))
+        elif kind == 'thread':
+            # The worker threads share this process' models and torch's intra-op
+            # threads. Single predictions run their forward pass in the batch
+            # scheduler thread, batch predictions in the worker thread itself, and
+            # the engine runs one forward pass at a time so they don't oversubscribe
+            # the cores
+            self.executor = ThreadPoolExecutor(workers, thread_name_prefix='worker')
+        else:
+            raise ValueError(f"Unknown worker kind: {kind}")
+        self.slots = threading.BoundedSemaphore(workers + max_queue)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+
+    # Take a slot, raises PoolSaturated when none is free unless blocking
+    def acquire(self, blocking=False):
+        if not self.slots.acquire(blocking=blocking):
+            raise PoolSaturated()
+        with self.lock:
+            self.in_flight += 1
+
+    def release(self, future=None):
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    # Submit fn(*args) to the executor, process workers send their metrics
+    # back with the result
+    def submit(self, fn, *args):
+        if self.kind == 'process':
+            return self.executor.submit(call_with_metrics, fn, *args)
+        return self.executor.submit(fn, *args)
+
+    # Merge the metrics a process worker sent back and return the result
+    def unwrap(self, result):
+        if self.kind == 'process':
+            result, drained = result
+            metrics.merge(drained)
+        return result
+
+    # Run fn(*args) on a worker, raises PoolSaturated instead of queueing
+    # beyond the limit
+    async def run(self, fn, *args):
+        self.acquire()
+        try:
+            future = self.submit(fn, *args)
+        except Exception:
+            self.release()
+            raise
+        future.add_done_callback(self.release)
+        return self.unwrap(await asyncio.wrap_future(future))
+
+    # Run fn(*args) on a worker under a slot the caller acquired, so a
+    # request made of several calls holds one slot from its first call to
+    # its last
+    async def run_acquired(self, fn, *args):
+        return self.unwrap(await asyncio.wrap_future(self.submit(fn, *args)))
+
+    # Blocking run_acquired, for callers outside the event loop
+    def call_acquired(self, fn, *args):
+        return self.unwrap(self.submit(fn, *args).result())
+
+# Pool shared by all requests of this process
+_pool = None
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = WorkerPool()
+        metrics.register(metrics.CallbackMetric('protein_requests_in_flight',
+            'Calls running on or waiting for a worker', 'gauge', lambda: _pool.in_flight))
+        metrics.register(metrics.CallbackMetric('protein_worker_queue_depth',
+            'Calls waiting for a worker', 'gauge', lambda: max(0, _pool.in_flight - _pool.workers)))
+    return _pool
@@ -0,0 +1,133 @@
+# Asynchronous prediction jobs for long proteins and large submissions
+import itertools
+import os
+import queue
+import threading
+import time
+import uuid
+from model import chunk_records, predict_records, normalize
+from workers import get_pool
+
+# Job configuration
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 1))
+JOB_TTL = float(os.environ.get('JOB_TTL', 3600))
+JOB_MAX_PENDING = int(os.environ.get('JOB_MAX_PENDING', 1000))
+JOB_CHUNK_SIZE = int(os.environ.get('JOB_CHUNK_SIZE', 16))
+
+class JobQueueFull(Exception):
+    """ Raised when too many jobs are waiting to run """
+
+class Job:
+    """ Prediction of a list of (id, sequence) records for several tasks
+
+    Args:
+        tasks: tasks to predict
+        records: list of (id, sequence) pairs
+    """
+    def __init__(self, tasks, records):
+        self.id = uuid.uuid4().hex
+        self.tasks = tasks
+        self.records = records
+        self.residues = sum(len(normalize(sequence)) for _, sequence in records)
+        self.total = len(records)
+        self.done = 0
+        self.results = []
+        self.status = 'queued'
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def info(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'progress': self.done/self.total if self.total > 0 else 1.0,
+            'done': self.done,
+            'total': self.total,
+            'residues': self.residues,
+            'created': self.created,
+            'finished': self.finished,
+            'error': self.error,
+            }
+
+class JobManager:
+    """ Runs jobs shortest (in residues) first and keeps finished jobs for ttl
+    seconds. Each job thread waits for a slot of the worker pool and runs its
+    chunks there, so jobs share the cores and models of the request handlers
+
+    Args:
+        workers: number of job threads, i.e. worker slots jobs may hold
+        ttl: seconds a finished job stays available
+        max_pending: jobs allowed to wait in the queue
+    """
+    def __init__(self, workers=JOB_WORKERS, ttl=JOB_TTL, max_pending=JOB_MAX_PENDING):
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._run, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, tasks, records):
+        self._purge()
+        if self.queue.qsize() >= self.max_pending:
+            raise JobQueueFull()
+        job = Job(tasks, list(records))
+        with self.lock:
+            self.jobs[job.id] = job
+        # Ties between equally long jobs are broken by submission order
+        self.queue.put((job.residues, next(self.counter), job.id))
+        return job
+
+    # Return the job or None if it is unknown or expired
+    def get(self, job_id):
+        self._purge()
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    # Drop the finished jobs older than the ttl
+    def _purge(self):
+        now = time.time()
+        with self.lock:
+            expired = [job_id for job_id, job in self.jobs.items()
+                       if job.finished is not None and now - job.finished > self.ttl]
+            for job_id in expired:
+                del self.jobs[job_id]
+
+    def _run(self):
+        while True:
+            _, _, job_id = self.queue.get()
+            with self.lock:
+                job = self.jobs.get(job_id)
+            if job is None:
+                continue
+            pool = get_pool()
+            pool.acquire(blocking=True)
+            job.status = 'running'
+            try:
+                for chunk in chunk_records(job.records, JOB_CHUNK_SIZE):
+                    results = pool.call_acquired(predict_records, chunk, job.tasks)
+                    job.results.extend(results)
+                    job.done += len(results)
+                job.status = 'done'
+            except Exception as e:
+                job.status = 'failed'
+                job.error = str(e)
+            finally:
+                pool.release()
+            job.records = None
+            job.finished = time.time()
+
+# Job manager shared by all requests of this process
+_manager = None
+
+def get_manager():
+    global _manager
+    if _manager is None:
+        _manager = JobManager()
+    return _manager
@@ -1,11 +1,37 @@
 # Import dependencies
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Query, HTTPException, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel, ValidationError, validate_arguments, BaseConfig
-from model import create_temp_fa, model_details, embed, predict, convert
+from typing import List, Optional
+from model import get_engine, get_registry, chunk_records, predict_records, predict_task, predict_tasks, read_fasta
+from workers import get_pool, PoolSaturated, RETRY_AFTER
+from jobs import get_manager, JobQueueFull
+import metrics
 import numpy as np
+import json
 
 app = FastAPI()
 
+# Load the embedding models and classifiers once, when the application starts,
+# process workers load their own copies
+@app.on_event("startup")
+def load_models():
+    if get_pool().kind == 'thread':
+        get_engine()
+        get_registry()
+
+# Answer 503 when the worker pool is saturated
+def pool_busy():
+    return HTTPException(status_code=503, detail="Server busy, try again later",
+                         headers={'Retry-After': str(RETRY_AFTER)})
+
+# Run a function on the worker pool, answer 503 when the pool is saturated
+async def run_in_pool(fn, *args):
+    try:
+        return await get_pool().run(fn, *args)
+    except PoolSaturated:
+        raise pool_busy()
+
 # pydantic models
 class ProteinIn(BaseModel):
     task : str
@@ -14,37 +40,166 @@ class ProteinIn(BaseModel):
 class ProteinOut(ProteinIn):
     prediction: str
 
-# /predict endpoint
-@app.post("/predict", response_model=ProteinOut, status_code=200)
-def get_prediction(payload: ProteinIn):
-    task_in = payload.task.lower()
-    protein = payload.protein
+class TasksIn(BaseModel):
+    tasks: List[str]
+    protein: str
 
-    # Check if task is valid
+class TasksOut(TasksIn):
+    predictions: dict
+
+class BatchIn(BaseModel):
+    tasks: List[str]
+    proteins: List[str]
+    ids: Optional[List[str]] = None
+
+class JobInfo(BaseModel):
+    job_id: str
+    status: str
+    progress: float
+    done: int
+    total: int
+    residues: int
+    created: float
+    finished: Optional[float] = None
+    error: Optional[str] = None
+
+# Check if task is valid and map it to the name of its model
+def check_task(task_in):
     valid_tasks = ['acp', 'amp', 'dbp', 'dna_binding']
     if task_in not in valid_tasks:
         raise HTTPException(status_code=400, detail="Task not available")
 
     if task_in == 'dna_binding':
-        task = 'dbp'
-    else:
-        task = task_in
+        return 'dbp'
+    return task_in
 
-    # Create temporary fasta file
-    path_fa = create_temp_fa(protein)
-
-    # Get model details
-    pt_model, pool, model_file = model_details(task)
+# /predict endpoint
+@app.post("/predict", response_model=ProteinOut, status_code=200)
+async def get_prediction(payload: ProteinIn):
+    task_in = payload.task.lower()
+    protein = payload.protein
 
-    # Embed the protein
-    embedding = embed(path_fa, pt_model, pool)
+    # Check if task is valid
+    task = check_task(task_in)
 
-    # Predict the protein
-    prediction = predict(embedding, model_file)
+    # Embed and predict the protein
+    prediction = await run_in_pool(predict_task, task, protein)
 
     response_object = {
         "task": task_in,
         "protein": protein,
-        "prediction": convert(prediction, task)
+        "prediction": prediction
     }
     return response_object
+
+
+# Check the requested tasks, dropping repeats
+def check_tasks(tasks_in):
+    if len(tasks_in) == 0:
+        raise HTTPException(status_code=400, detail="Task not available")
+    tasks = []
+    for task_in in tasks_in:
+        task = check_task(task_in.lower())
+        if task not in tasks:
+            tasks.append(task)
+    return tasks
+
+# /predict/tasks endpoint, predicts one protein for several tasks,
+# embedding it only once for every pretrained model the tasks share
+@app.post("/predict/tasks", response_model=TasksOut, status_code=200)
+async def get_tasks_prediction(payload: TasksIn):
+    tasks = check_tasks(payload.tasks)
+    predictions = await run_in_pool(predict_tasks, payload.protein, tasks)
+
+    response_object = {
+        "tasks": tasks,
+        "protein": payload.protein,
+        "predictions": predictions
+    }
+    return response_object
+
+# Ids of the proteins of a batch, their position unless given
+def batch_records(payload):
+    ids = payload.ids
+    if ids is None:
+        ids = [str(i) for i in range(len(payload.proteins))]
+    elif len(ids) != len(payload.proteins):
+        raise HTTPException(status_code=400, detail="Number of ids and proteins differ")
+    return zip(ids, payload.proteins)
+
+# /predict/batch endpoint, accepts a json body with a list of proteins or
+# a multipart form with a fasta file and one or more task fields,
+# streams back one json line per protein
+@app.post("/predict/batch", status_code=200)
+async def get_batch_prediction(request: Request):
+    content_type = request.headers.get('content-type', '')
+    if content_type.startswith('multipart/form-data'):
+        form = await request.form()
+        upload = form.get('file')
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail="Fasta file missing")
+        tasks_in = form.getlist('task')
+        records = read_fasta(upload.file)
+    else:
+        try:
+            body = await request.json()
+            if not isinstance(body, dict):
+                raise HTTPException(status_code=422, detail="Request body must be a JSON object")
+            payload = BatchIn(**body)
+        except (ValueError, ValidationError) as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        tasks_in = payload.tasks
+        records = batch_records(payload)
+
+    tasks = check_tasks(tasks_in)
+
+    # The whole stream holds one worker slot, taken before answering
+    pool = get_pool()
+    try:
+        pool.acquire()
+    except PoolSaturated:
+        raise pool_busy()
+    return StreamingResponse(stream_batch(pool, records, tasks), media_type='application/x-ndjson')
+
+# Predict the records a chunk at a time on the worker pool, under the slot
+# acquired for the request, and release it when the stream ends
+async def stream_batch(pool, records, tasks):
+    try:
+        for chunk in chunk_records(records):
+            for result in await pool.run_acquired(predict_records, chunk, tasks):
+                yield json.dumps(result) + '\n'
+    finally:
+        pool.release()
+
+# /jobs endpoints, submit a batch, poll its status and fetch its results
+# while they are kept; shorter jobs run first
+@app.post("/jobs", response_model=JobInfo, status_code=202)
+def submit_job(payload: BatchIn):
+    tasks = check_tasks(payload.tasks)
+    try:
+        job = get_manager().submit(tasks, batch_records(payload))
+    except JobQueueFull:
+        raise HTTPException(status_code=503, detail="Too many pending jobs, try again later",
+                            headers={'Retry-After': str(RETRY_AFTER)})
+    return job.info()
+
+@app.get("/jobs/{job_id}", response_model=JobInfo, status_code=200)
+def get_job(job_id: str):
+    job = get_manager().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.info()
+
+@app.get("/jobs/{job_id}/result", status_code=200)
+def get_job_result(job_id: str):
+    job = get_manager().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status != 'done':
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    return {'job_id': job.id, 'results': job.results}
+
+# /metrics endpoint, stage latencies and service counters in Prometheus text format
+@app.get('/metrics', response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
@@ -1,46 +1,744 @@
 from __future__ import print_function,division
 
+import os
 import sys
+import time
+import queue
+import hashlib
+import threading
 import numpy as np
-import h5py
 
 import torch
+from torch.nn.utils.rnn import PackedSequence
 
 from prose.alphabets import Uniprot21
+from prose.utils import pack_sequences, unpack_sequences, quantize, dequantize, DTYPES
 import prose.fasta as fasta
 
 
-def embed_sequence(model, x, pool='none', use_cuda=False):
+def pool_embedding(z, pool='none'):
+    """ reduce an (L, D) per-residue embedding over the sequence positions """
+    if pool == 'sum':
+        z = z.sum(0)
+    elif pool == 'max':
+        z,_ = z.max(0)
+    elif pool == 'avg':
+        z = z.mean(0)
+    return z
+
+
+def encode_sequence(x, alphabet=Uniprot21()):
+    """ convert a byte string sequence to a tensor of alphabet indices, in memory.
+    Sequences that are already encoded are returned as they are """
+    if torch.is_tensor(x):
+        return x
+    x = alphabet.encode(x.upper())
+    return torch.from_numpy(x).long()
+
+
+def embedding_dim(model):
+    """ size of the per-residue embeddings returned by model.transform """
+    if hasattr(model, 'embedding'):
+        model = model.embedding
+    return model.proj.weight.size(1)
+
+
+def pools_streamed(model, pools):
+    """ whether the pooled embeddings can be reduced layer by layer inside the model,
+    without building the full per-residue tensor """
+    return hasattr(model, 'transform_pooled') and 'none' not in pools
+
+
+def embed_sequence(model, x, pool='none', use_cuda=False, exact=False):
+    """ embed one sequence. pool can also be a list of pooling operations, all computed
+    from the same forward pass, in which case a dict keyed by pooling operation is returned.
+    Pooled embeddings are reduced layer by layer without building the per-residue tensor,
+    which changes the last bits of sum and avg; with exact they are pooled from the
+    per-residue tensor as before. """
+    pools = None
+    if isinstance(pool, (list, tuple)):
+        pools = pool
+
     if len(x) == 0:
-        n = model.embedding.proj.weight.size(1)
+        n = embedding_dim(model)
+        if pools is not None:
+            return {p: np.zeros((1,n), dtype=np.float32) for p in pools}
         z = np.zeros((1,n), dtype=np.float32)
         return z
 
-    alphabet = Uniprot21()
-    x = x.upper()
     # convert to alphabet index
-    x = alphabet.encode(x)
-    x = torch.from_numpy(x)
+    x = encode_sequence(x)
     if use_cuda:
         x = x.cuda()
 
     # embed the sequence
     with torch.no_grad():
-        x = x.long().unsqueeze(0)
+        x = x.unsqueeze(0)
+        if not exact and pools_streamed(model, pools or [pool]):
+            Z = model.transform_pooled(x, pools=pools or [pool])
+            if pools is None:
+                return Z[pool][0].cpu().numpy()
+            return {p: Z[p][0].cpu().numpy() for p in pools}
+
         z = model.transform(x)
         # pool if needed
         z = z.squeeze(0)
-        if pool == 'sum':
-            z = z.sum(0)
-        elif pool == 'max':
-            z,_ = z.max(0)
-        elif pool == 'avg':
-            z = z.mean(0)
-        z = z.cpu().numpy()
+        if pools is None:
+            z = pool_embedding(z, pool).cpu().numpy()
+        else:
+            z = {p: pool_embedding(z, p).cpu().numpy() for p in pools}
 
     return z
 
 
+def length_batches(lengths, batch_size=None, max_tokens=None):
+    """ group sequence indices into batches of similar length, yields lists of indices
+    holding at most batch_size sequences and max_tokens residues """
+    order = np.argsort(lengths, kind='stable')
+    batch = []
+    tokens = 0
+    for i in order:
+        n = lengths[i]
+        full = batch_size is not None and len(batch) >= batch_size
+        full = full or (max_tokens is not None and tokens + n > max_tokens)
+        if len(batch) > 0 and full:
+            yield batch
+            batch = []
+            tokens = 0
+        batch.append(i)
+        tokens += n
+    if len(batch) > 0:
+        yield batch
+
+
+def embed_batch(model, xs, pool='none', use_cuda=False, exact=False):
+    """ embed a list of sequences as one packed batch, results keep the input order.
+    pool can also be a list of pooling operations, all computed from the same
+    forward pass, in which case each result is a dict keyed by pooling operation.
+    exact is as in embed_sequence. """
+    zs = [None]*len(xs)
+    pools = None
+    if isinstance(pool, (list, tuple)):
+        pools = pool
+
+    X = []
+    index = []
+    for i in range(len(xs)):
+        x = xs[i]
+        if len(x) == 0:
+            # empty sequences can't be packed
+            zs[i] = embed_sequence(model, x, pool=pool, use_cuda=use_cuda, exact=exact)
+            continue
+        X.append(encode_sequence(x))
+        index.append(i)
+
+    if len(X) == 0:
+        return zs
+
+    # embed the sequences
+    with torch.no_grad():
+        X,order = pack_sequences(X)
+        if use_cuda:
+            X = PackedSequence(X.data.cuda(), X.batch_sizes)
+        if not exact and pools_streamed(model, pools or [pool]):
+            Z = model.transform_pooled(X, pools=pools or [pool])
+            # rows of the packed batch follow order
+            for k in range(len(order)):
+                i = index[order[k]]
+                if pools is None:
+                    zs[i] = Z[pool][k].cpu().numpy()
+                else:
+                    zs[i] = {p: Z[p][k].cpu().numpy() for p in pools}
+            return zs
+
+        Z = model.transform(X)
+        Z = unpack_sequences(Z, order)
+        # pool if needed
+        for i,z in zip(index, Z):
+            if pools is None:
+                zs[i] = pool_embedding(z, pool).cpu().numpy()
+            else:
+                zs[i] = {p: pool_embedding(z, p).cpu().numpy() for p in pools}
+
+    return zs
+
+
+def windows(n, window, overlap=0):
+    """ split n positions into windows of at most window positions overlapping by overlap,
+    yields (start, end, keep_start, keep_end). The kept ranges split the overlaps in half
+    and together cover every position exactly once. """
+    if overlap >= window:
+        raise ValueError('window overlap must be smaller than the window')
+    step = window - overlap
+    start = 0
+    while True:
+        end = min(start + window, n)
+        keep_start = start if start == 0 else start + overlap//2
+        if end == n:
+            yield start, end, keep_start, end
+            return
+        yield start, end, keep_start, end - (overlap - overlap//2)
+        start += step
+
+
+def forward_floats(model):
+    """ float32 values held per residue at the peak of a forward pass: the layer outputs,
+    their concatenation and the input gates (4*hidden per direction) the LSTM layer being
+    run precomputes for the whole window """
+    gates = 0
+    for module in model.modules():
+        if isinstance(module, torch.nn.LSTM):
+            directions = 2 if module.bidirectional else 1
+            gates = max(gates, 4*module.hidden_size*directions)
+    return 2*embedding_dim(model) + gates
+
+
+def window_for_memory(model, max_memory):
+    """ longest window whose forward pass fits in max_memory bytes. Only the activations
+    are counted, not the model weights, and with a 25% margin for the workspace of the
+    LSTM kernels """
+    return max(1, int(max_memory//(forward_floats(model)*4*1.25)))
+
+
+def embed_chunked(model, x, pool='none', use_cuda=False, window=1000, overlap=0, max_memory=None, exact=False):
+    """ embed a long sequence in overlapping windows. Per-residue outputs of the windows are
+    stitched together and pooled statistics are merged over the stitched positions, so peak
+    memory depends on the window rather than the sequence length. Positions near window
+    edges see less context than in a single pass. Raises MemoryError when the per-residue
+    output itself would exceed max_memory bytes. """
+    pools = pool
+    if not isinstance(pool, (list, tuple)):
+        pools = [pool]
+
+    n = len(x)
+    dim = embedding_dim(model)
+    if max_memory is not None:
+        window = min(window, window_for_memory(model, max_memory))
+        overlap = min(overlap, window//2)
+        if 'none' in pools and n*dim*4 > max_memory:
+            raise MemoryError('per-residue embedding of {} residues exceeds the memory limit'.format(n))
+    if n <= window:
+        return embed_sequence(model, x, pool=pool, use_cuda=use_cuda, exact=exact)
+
+    x = encode_sequence(x)
+    parts = []
+    total = None
+    z_max = None
+    with torch.no_grad():
+        for start,end,keep_start,keep_end in windows(n, window, overlap):
+            xw = x[start:end].unsqueeze(0)
+            if use_cuda:
+                xw = xw.cuda()
+            z = model.transform(xw).squeeze(0)
+            z = z[keep_start-start:keep_end-start]
+            if 'none' in pools:
+                parts.append(z.cpu())
+            if 'sum' in pools or 'avg' in pools:
+                total = z.sum(0) if total is None else total + z.sum(0)
+            if 'max' in pools:
+                z,_ = z.max(0)
+                z_max = z if z_max is None else torch.max(z_max, z)
+            del z
+
+    zs = {}
+    for p in pools:
+        if p == 'none':
+            zs[p] = torch.cat(parts, 0).numpy()
+        elif p == 'sum':
+            zs[p] = total.cpu().numpy()
+        elif p == 'avg':
+            zs[p] = (total/n).cpu().numpy()
+        elif p == 'max':
+            zs[p] = z_max.cpu().numpy()
+
+    if not isinstance(pool, (list, tuple)):
+        return zs[pool]
+    return zs
+
+
+def embed_stream(model, records, pool='none', use_cuda=False, batch_size=1, max_tokens=None, buffer_size=None
+                , window=None, overlap=0, max_memory=None, skip=None, exact=False):
+    """ embed (name, sequence) records, yields (name, embedding) in the input order.
+    With batch_size > 1 or max_tokens set, up to buffer_size records are buffered,
+    sorted into length buckets and embedded as packed batches. Sequences longer than
+    window residues (or than fit in max_memory bytes) are embedded in chunks. Records
+    whose sequence is None are passed through with a None embedding. A sequence whose
+    per-residue embedding exceeds max_memory raises MemoryError, unless skip is given,
+    then skip(name, error) is called and the record is left out. exact is as in
+    embed_sequence. """
+    if max_memory is not None:
+        limit = window_for_memory(model, max_memory)
+        window = limit if window is None else min(window, limit)
+    chunking = (window, overlap, max_memory)
+
+    if batch_size <= 1 and max_tokens is None:
+        for name,x in records:
+            if x is None:
+                yield name, None
+            elif window is not None and len(x) > window:
+                try:
+                    z = embed_chunked(model, x, pool=pool, use_cuda=use_cuda, window=window, overlap=overlap, max_memory=max_memory, exact=exact)
+                except MemoryError as e:
+                    if skip is None:
+                        raise
+                    skip(name, e)
+                    continue
+                yield name, z
+            else:
+                yield name, embed_sequence(model, x, pool=pool, use_cuda=use_cuda, exact=exact)
+        return
+
+    if buffer_size is None:
+        buffer_size = 64*max(batch_size, 1)
+
+    buffer = []
+    for record in records:
+        buffer.append(record)
+        if len(buffer) >= buffer_size:
+            yield from embed_buffer(model, buffer, pool, use_cuda, batch_size, max_tokens, chunking, skip, exact)
+            buffer = []
+    if len(buffer) > 0:
+        yield from embed_buffer(model, buffer, pool, use_cuda, batch_size, max_tokens, chunking, skip, exact)
+
+
+def embed_buffer(model, buffer, pool, use_cuda, batch_size, max_tokens, chunking=(None, 0, None), skip=None, exact=False):
+    window,overlap,max_memory = chunking
+    zs = [None]*len(buffer)
+    skipped = set()
+    # long sequences are embedded on their own, in chunks
+    index = []
+    for i in range(len(buffer)):
+        x = buffer[i][1]
+        if x is None:
+            continue
+        if window is not None and len(x) > window:
+            try:
+                zs[i] = embed_chunked(model, x, pool=pool, use_cuda=use_cuda, window=window, overlap=overlap, max_memory=max_memory, exact=exact)
+            except MemoryError as e:
+                if skip is None:
+                    raise
+                skip(buffer[i][0], e)
+                skipped.add(i)
+        else:
+            index.append(i)
+    lengths = [len(buffer[i][1]) for i in index]
+    for batch in length_batches(lengths, batch_size=batch_size, max_tokens=max_tokens):
+        batch = [index[j] for j in batch]
+        Z = embed_batch(model, [buffer[i][1] for i in batch], pool=pool, use_cuda=use_cuda, exact=exact)
+        for i,z in zip(batch, Z):
+            zs[i] = z
+    for i,((name,_),z) in enumerate(zip(buffer, zs)):
+        if i not in skipped:
+            yield name, z
+
+
+class Deduplicator:
+    """ replaces the sequence of every record whose sequence was already seen by None
+    and remembers the name of its first occurrence """
+    def __init__(self):
+        self.seen = {}
+        self.source = {}
+        self.total = 0
+
+    def __call__(self, records):
+        for name,sequence in records:
+            self.total += 1
+            key = hashlib.sha1(sequence.upper()).digest()
+            if key in self.seen:
+                self.source[name] = self.seen[key]
+                yield name, None
+            else:
+                self.seen[key] = name
+                yield name, sequence
+
+    @property
+    def unique(self):
+        return len(self.seen)
+
+
+class StageTimer:
+    """ time a pipeline stage spends working and waiting on its queues """
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.waiting = 0.0
+
+    def utilization(self, elapsed):
+        return self.busy/max(elapsed, 1e-9)
+
+
+def _put(q, item, stop):
+    """ put item on a bounded queue unless stop gets set while waiting, returns
+    whether it was put """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+_DONE = object()
+
+
+def read_ahead(records, queue_size, reader, consumer, encode=True):
+    """ iterate over (name, sequence) records in a background thread that parses and,
+    with encode, converts the sequences to alphabet indices up to queue_size records
+    ahead of the consumer. Time spent by either side is added to the reader and
+    consumer StageTimers. """
+    q = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def produce():
+        try:
+            records_ = iter(records)
+            while True:
+                start = time.perf_counter()
+                try:
+                    name,x = next(records_)
+                except StopIteration:
+                    break
+                if encode and x is not None:
+                    x = encode_sequence(x)
+                reader.busy += time.perf_counter() - start
+                start = time.perf_counter()
+                put = _put(q, (name,x), stop)
+                reader.waiting += time.perf_counter() - start
+                if not put:
+                    return
+        except BaseException as e:
+            errors.append(e)
+        _put(q, _DONE, stop)
+
+    thread = threading.Thread(target=produce, name='reader', daemon=True)
+    thread.start()
+    try:
+        while True:
+            start = time.perf_counter()
+            item = q.get()
+            consumer.waiting += time.perf_counter() - start
+            if item is _DONE:
+                break
+            yield item
+        if len(errors) > 0:
+            raise errors[0]
+    finally:
+        stop.set()
+        thread.join()
+
+
+class BackgroundWriter:
+    """ calls write(name, z) on the items put on a bounded queue, in order, from a
+    background thread. Time spent by either side is added to the writer and producer
+    StageTimers. Errors raised by write are raised again by put and close. """
+    def __init__(self, write, queue_size, writer, producer):
+        self.write = write
+        self.timer = writer
+        self.producer = producer
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.errors = []
+        self.thread = threading.Thread(target=self.drain, name='writer', daemon=True)
+        self.thread.start()
+
+    def drain(self):
+        while True:
+            start = time.perf_counter()
+            item = self.queue.get()
+            self.timer.waiting += time.perf_counter() - start
+            if item is _DONE:
+                return
+            start = time.perf_counter()
+            try:
+                self.write(*item)
+            except BaseException as e:
+                self.errors.append(e)
+                self.stop.set()
+                return
+            self.timer.busy += time.perf_counter() - start
+
+    def check(self):
+        if len(self.errors) > 0:
+            raise self.errors[0]
+
+    def put(self, name, z):
+        self.check()
+        start = time.perf_counter()
+        _put(self.queue, (name,z), self.stop)
+        self.producer.waiting += time.perf_counter() - start
+        self.check()
+
+    def close(self):
+        """ write out the queued items and stop the thread """
+        _put(self.queue, _DONE, self.stop)
+        self.thread.join()
+        self.check()
+
+
+class EmbeddingWriter:
+    """ writes embeddings to an HDF5 file, one dataset per sequence.
+
+    With resume, an existing file is opened for appending and the ids it already holds can
+    be skipped. The file is flushed every flush_interval sequences and its 'complete'
+    attribute is set once the run finishes. Embeddings are stored as dtype, the scales of
+    the vectors of an int8 dataset are the dataset of the same name in the 'scales' group
+    (attributes are limited to 64KB, too little for long sequences). """
+    scales = 'scales'
+
+    def __init__(self, path, resume=False, flush_interval=1000, compression=None, dtype='float32'):
+        import h5py
+        self.path = path
+        self.h5 = h5py.File(path, 'a' if resume else 'w')
+        self.resumed = len(self.h5) - (self.scales in self.h5)
+        check_dtype(self.h5, dtype)
+        self.h5.attrs['complete'] = False
+        self.flush_interval = flush_interval
+        self.compression = compression
+        self.dtype = dtype
+        self.pending = 0
+
+    def __contains__(self, pid):
+        return pid != self.scales and pid in self.h5
+
+    def __getitem__(self, pid):
+        dataset = self.h5[pid]
+        scale = dataset.attrs.get('scale')
+        if self.scales + '/' + pid in self.h5:
+            scale = self.h5[self.scales][pid][()]
+        return dequantize(dataset[:], scale)
+
+    def write(self, pid, z):
+        q,scale = quantize(z, self.dtype)
+        if scale is not None:
+            # the scales go first, the embedding marks the sequence as written
+            name = self.scales + '/' + pid
+            if name in self.h5:
+                # left over by an interrupted run
+                del self.h5[name]
+            self.h5.create_dataset(name, data=scale)
+        self.h5.create_dataset(pid, data=q, compression=self.compression)
+        self.pending += 1
+        if self.flush_interval > 0 and self.pending >= self.flush_interval:
+            self.flush()
+
+    def link(self, pid, source):
+        """ store the embedding already written for source under pid as well, as an HDF5
+        hard link, so it takes no extra space """
+        if self.scales + '/' + source in self.h5:
+            name = self.scales + '/' + pid
+            if name in self.h5:
+                del self.h5[name]
+            self.h5[name] = self.h5[self.scales][source]
+        self.h5[pid] = self.h5[source]
+        self.pending += 1
+        if self.flush_interval > 0 and self.pending >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.h5.flush()
+        self.pending = 0
+
+    def close(self, complete=False):
+        if complete:
+            self.h5.attrs['complete'] = True
+        self.h5.close()
+
+
+class ConsolidatedWriter:
+    """ writes embeddings to an HDF5 file as one contiguous, chunked 'embeddings' dataset.
+
+    Pooled embeddings are the rows of an (N, D) dataset. Per-residue embeddings are
+    concatenated into a (total_residues, D) dataset, sequence i spanning the rows
+    offsets[i]:offsets[i+1]. The 'ids' dataset holds the sequence ids in row order.
+    Sequences are buffered and appended every flush_interval sequences (or 64MB).
+    With resume, rows past the last written id are dropped and the ids already written
+    can be skipped. Duplicates are written as copies, rows can't be hard linked.
+    Embeddings are stored as dtype, with int8 the 'scales' dataset holds the scale of
+    every row. """
+    max_buffer = 2**26
+
+    def __init__(self, path, pooled, resume=False, flush_interval=1000, compression=None, dtype='float32'):
+        import h5py
+        self.path = path
+        self.pooled = pooled
+        self.dtype = dtype
+        self.h5 = h5py.File(path, 'a' if resume else 'w')
+        check_dtype(self.h5, dtype)
+        self.index = {}
+        self.rows = 0
+        if 'ids' in self.h5:
+            ids = [pid.decode('utf-8') if isinstance(pid, bytes) else pid for pid in self.h5['ids'][:]]
+            self.index = {pid: i for i,pid in enumerate(ids)}
+            if not pooled:
+                self.h5['offsets'].resize(len(ids) + 1, axis=0)
+                self.rows = int(self.h5['offsets'][len(ids)])
+            else:
+                self.rows = len(ids)
+            # drop the rows of an interrupted flush
+            self.h5['embeddings'].resize(self.rows, axis=0)
+            if 'scales' in self.h5:
+                self.h5['scales'].resize(self.rows, axis=0)
+        self.resumed = len(self.index)
+        self.written = len(self.index)
+        self.h5.attrs['complete'] = False
+        self.h5.attrs['layout'] = 'consolidated'
+        self.flush_interval = flush_interval
+        self.compression = compression
+        self.ids = []
+        self.buffer = []
+        self.buffered = 0
+
+    def __contains__(self, pid):
+        return pid in self.index
+
+    def __getitem__(self, pid):
+        i = self.index[pid]
+        if i >= self.written:
+            return self.buffer[i - self.written]
+        if self.pooled:
+            start,end = i,i+1
+        else:
+            start,end = self.h5['offsets'][i:i+2]
+        scale = None
+        if 'scales' in self.h5:
+            scale = self.h5['scales'][start:end]
+        z = dequantize(self.h5['embeddings'][start:end], scale)
+        if self.pooled:
+            z = z[0]
+        return z
+
+    def write(self, pid, z):
+        self.index[pid] = self.written + len(self.buffer)
+        self.ids.append(pid)
+        self.buffer.append(z)
+        self.buffered += z.nbytes
+        full = self.flush_interval > 0 and len(self.buffer) >= self.flush_interval
+        if full or self.buffered >= self.max_buffer:
+            self.flush()
+
+    def link(self, pid, source):
+        """ store a copy of the embedding already written for source under pid """
+        self.write(pid, self[source])
+
+    def create(self, dim):
+        import h5py
+        # chunks of about 1MB
+        dtype = np.dtype(self.dtype)
+        rows = max(1, 2**20//(dtype.itemsize*dim))
+        self.h5.create_dataset('embeddings', shape=(0, dim), maxshape=(None, dim), dtype=dtype
+                              , chunks=(rows, dim), compression=self.compression)
+        if self.dtype == 'int8':
+            self.h5.create_dataset('scales', shape=(0,), maxshape=(None,), dtype=np.float32)
+        if not self.pooled:
+            self.h5.create_dataset('offsets', data=np.zeros(1, dtype=np.int64), maxshape=(None,))
+        self.h5.create_dataset('ids', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype())
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            Z = [z.reshape(-1, z.shape[-1]) for z in self.buffer]
+            if 'embeddings' not in self.h5:
+                self.create(Z[0].shape[1])
+            ids = self.ids
+            lengths = [len(z) for z in Z]
+            Z = np.concatenate(Z, 0)
+
+            # the ids are appended last, they mark which rows are complete
+            n = self.written
+            Z,scale = quantize(Z, self.dtype)
+            embeddings = self.h5['embeddings']
+            embeddings.resize(self.rows + len(Z), axis=0)
+            embeddings[self.rows:] = Z
+            if scale is not None:
+                self.h5['scales'].resize(self.rows + len(Z), axis=0)
+                self.h5['scales'][self.rows:] = scale
+            if not self.pooled:
+                offsets = self.h5['offsets']
+                offsets.resize(n + len(ids) + 1, axis=0)
+                offsets[n+1:] = self.rows + np.cumsum(lengths)
+            self.h5['ids'].resize(n + len(ids), axis=0)
+            self.h5['ids'][n:] = ids
+
+            self.rows += len(Z)
+            self.written += len(ids)
+            self.ids = []
+            self.buffer = []
+            self.buffered = 0
+        self.h5.flush()
+
+    def close(self, complete=False):
+        self.flush()
+        if complete:
+            self.h5.attrs['complete'] = True
+        self.h5.close()
+
+
+def check_dtype(h5, dtype):
+    """ record the storage dtype of a new output, or check that an output being
+    resumed was written with the same one """
+    if h5.attrs.get('dtype', dtype) != dtype:
+        raise ValueError('{} holds {} embeddings, not {}'.format(h5.filename, h5.attrs['dtype'], dtype))
+    h5.attrs['dtype'] = dtype
+
+
+LAYOUTS = ['per-sequence', 'consolidated', 'store']
+
+
+def open_writer(path, pool, layout='per-sequence', resume=False, flush_interval=1000, compression=None, dtype='float32'):
+    """ open the writer of one pooling operation's output in the given layout """
+    if layout == 'store':
+        from prose.store import ResidueStoreWriter
+        return ResidueStoreWriter(path, resume=resume, flush_interval=flush_interval, dtype=dtype)
+    if layout == 'consolidated':
+        return ConsolidatedWriter(path, pool != 'none', resume=resume, flush_interval=flush_interval
+                                 , compression=compression, dtype=dtype)
+    return EmbeddingWriter(path, resume=resume, flush_interval=flush_interval, compression=compression, dtype=dtype)
+
+
+def load_model(name):
+    """ load a pre-trained model by name or unpickle a torch model, in eval mode """
+    if name == 'prose_mt':
+        from prose.models.multitask import ProSEMT
+        print('# loading the pre-trained ProSE MT model', file=sys.stderr)
+        model = ProSEMT.load_pretrained()
+    elif name == 'prose_dlm':
+        from prose.models.lstm import SkipLSTM
+        print('# loading the pre-trained ProSE DLM model', file=sys.stderr)
+        model = SkipLSTM.load_pretrained()
+    else:
+        print('# loading model:', name, file=sys.stderr)
+        model = torch.load(name)
+    model.eval()
+    return model
+
+
+POOLS = ['none', 'sum', 'max', 'avg']
+
+
+def parse_pools(s):
+    """ parse a comma separated list of pooling operations """
+    pools = []
+    for pool in s.split(','):
+        pool = pool.strip()
+        if pool not in POOLS:
+            raise ValueError('unknown pooling operation: ' + pool)
+        if pool not in pools:
+            pools.append(pool)
+    return pools
+
+
+def output_paths(output, pools):
+    """ output path of every pooling operation, {pool} in the output is replaced by
+    the operation, otherwise _<pool> is added before the extension when there are several """
+    if '{pool}' in output:
+        return {pool: output.replace('{pool}', pool) for pool in pools}
+    if len(pools) == 1:
+        return {pools[0]: output}
+    root,ext = os.path.splitext(output)
+    return {pool: root + '_' + pool + ext for pool in pools}
+
+
 def main():
     import argparse
     parser = argparse.ArgumentParser()
@@ -48,8 +746,23 @@ def main():
     parser.add_argument('path')
     parser.add_argument('-m', '--model', default='prose_mt', help='pretrained model to load, prose_mt loads the pretrained ProSE MT model, prose_dlm loads the pretrained Prose DLM model, otherwise unpickles torch model directly (default: prose_mt)')
     parser.add_argument('-o', '--output')
-    parser.add_argument('--pool', choices=['none', 'sum', 'max', 'avg'], default='none', help='apply some sort of pooling operation over each sequence (default: none)')
+    parser.add_argument('--pool', type=parse_pools, default='none', help='apply some sort of pooling operation over each sequence, one of none, sum, max, avg or a comma separated list of them, e.g. avg,max,sum, which are all computed from the same forward pass and written to one file each (default: none)')
     parser.add_argument('-d', '--device', type=int, default=-2, help='compute device to use')
+    parser.add_argument('--batch-size', type=int, default=1, help='embed up to this many sequences of similar length as one packed batch (default: 1)')
+    parser.add_argument('--max-tokens', type=int, help='maximum number of residues in one packed batch (default: no limit)')
+    parser.add_argument('--window', type=int, help='embed sequences longer than this in overlapping windows of this many residues (default: no windows)')
+    parser.add_argument('--overlap', type=int, default=0, help='residues shared by consecutive windows (default: 0)')
+    parser.add_argument('--no-dedup', action='store_true', help='embed duplicate sequences again instead of linking them to the first embedding of the same sequence')
+    parser.add_argument('--resume', action='store_true', help='append to an existing output, skipping the sequences it already holds (default: overwrite)')
+    parser.add_argument('--flush-interval', type=int, default=1000, help='flush the output to disk every this many sequences (default: 1000)')
+    parser.add_argument('--layout', choices=LAYOUTS, default='per-sequence', help='per-sequence writes one dataset per sequence, consolidated writes all the embeddings to one chunked dataset with an ids dataset (and an offsets dataset without pooling), store writes a memory-mapped ResidueStore directory instead of an HDF5 file (default: per-sequence)')
+    parser.add_argument('--compression', choices=['gzip', 'lzf'], help='compress the output datasets (default: no compression)')
+    parser.add_argument('--dtype', choices=DTYPES, default='float32', help='storage precision of the embeddings, float16 or int8 with a float32 scale per vector (default: float32)')
+    parser.add_argument('--pipeline', action='store_true', help='parse and encode the sequences in a background thread and write the embeddings in another one, so the model never waits on I/O')
+    parser.add_argument('--queue-size', type=int, help='records the background reader may parse ahead of the model with --pipeline (default: 128*batch-size)')
+    parser.add_argument('--max-memory', type=float, help='memory ceiling in MB for embedding one sequence, longer sequences are embedded in windows that fit, sequences whose per-residue embedding alone exceeds it are skipped and listed in the rejects file (default: no limit)')
+    parser.add_argument('--exact-pooling', action='store_true', help='pool the embeddings from the full per-residue tensor, bit for bit like earlier versions, instead of reducing them layer by layer inside the model')
+    parser.add_argument('--rejects', help='file listing the ids of the skipped sequences, one per line (default: the first output with .rejects appended)')
 
     args = parser.parse_args()
 
@@ -57,18 +770,7 @@ def main():
     path = args.path
 
     # load the model
-    if args.model == 'prose_mt':
-        from prose.models.multitask import ProSEMT
-        print('# loading the pre-trained ProSE MT model', file=sys.stderr)
-        model = ProSEMT.load_pretrained()
-    elif args.model == 'prose_dlm':
-        from prose.models.lstm import SkipLSTM
-        print('# loading the pre-trained ProSE DLM model', file=sys.stderr)
-        model = SkipLSTM.load_pretrained()
-    else:
-        print('# loading model:', args.model, file=sys.stderr)
-        model = torch.load(args.model)
-    model.eval()
+    model = load_model(args.model)
 
     # set the device
     d = args.device
@@ -80,22 +782,123 @@ def main():
         model = model.cuda()
 
     # parse the sequences and embed them
-    # write them to hdf5 file
-    print('# writing:', args.output, file=sys.stderr)
-    h5 = h5py.File(args.output, 'w')
+    # write them to one hdf5 file per pooling operation
+    pools = args.pool
+    outputs = output_paths(args.output, pools)
+    writers = {}
+    for pool in pools:
+        print('# writing:', outputs[pool], file=sys.stderr)
+        writers[pool] = open_writer(outputs[pool], pool, layout=args.layout, resume=args.resume
+                                   , flush_interval=args.flush_interval, compression=args.compression, dtype=args.dtype)
+        if args.resume:
+            print('# resuming after {} sequences'.format(writers[pool].resumed), file=sys.stderr)
 
-    pool = args.pool
-    print('# embedding with pool={}'.format(pool), file=sys.stderr)
+    print('# embedding with pool={}'.format(','.join(pools)), file=sys.stderr)
+    if args.batch_size > 1 or args.max_tokens is not None:
+        print('# embedding in batches of batch_size={}, max_tokens={}'.format(args.batch_size, args.max_tokens), file=sys.stderr)
+    max_memory = None
+    if args.max_memory is not None:
+        max_memory = args.max_memory*2**20
+    if args.window is not None or max_memory is not None:
+        print('# embedding long sequences in windows of window={}, overlap={}, max_memory={}MB'.format(args.window, args.overlap, args.max_memory), file=sys.stderr)
     count = 0
-    with open(path, 'rb') as f:
-        for name,sequence in fasta.parse_stream(f):
-            pid = name.decode('utf-8')
-            z = embed_sequence(model, sequence, pool=pool, use_cuda=use_cuda)
-            # write as hdf5 dataset
-            h5.create_dataset(pid, data=z)
-            count += 1
-            print('# {} sequences processed...'.format(count), file=sys.stderr, end='\r')
+    dedup = None
+
+    # sequences too long to embed are skipped, their ids are listed in the
+    # rejects file and skipped again by --resume
+    rejects_path = args.rejects
+    if rejects_path is None:
+        rejects_path = outputs[pools[0]] + '.rejects'
+    rejected = set()
+    if args.resume and os.path.exists(rejects_path):
+        with open(rejects_path, 'rb') as f:
+            # names are full header lines, which may hold spaces
+            rejected = set(f.read().splitlines())
+    # opened on the first rejected sequence, so runs without any leave no file
+    rejects = []
+
+    def skip(name, error):
+        print('# skipping {}: {}'.format(name.decode('utf-8'), error), file=sys.stderr)
+        rejected.add(name)
+        if len(rejects) == 0:
+            rejects.append(open(rejects_path, 'ab' if args.resume else 'wb'))
+        rejects[0].write(name + b'\n')
+        rejects[0].flush()
+
+    def write(name, z):
+        pid = name.decode('utf-8')
+        if z is None and dedup.source[name] in rejected:
+            # duplicate of a skipped sequence
+            skip(name, 'duplicate of ' + dedup.source[name].decode('utf-8'))
+            return
+        # write as hdf5 dataset
+        for pool in pools:
+            if pid in writers[pool]:
+                continue
+            if z is None:
+                writers[pool].link(pid, dedup.source[name].decode('utf-8'))
+            else:
+                writers[pool].write(pid, z[pool])
+
+    if args.pipeline:
+        queue_size = args.queue_size
+        if queue_size is None:
+            queue_size = 128*max(args.batch_size, 1)
+        print('# embedding in a pipeline, reading up to {} sequences ahead'.format(queue_size), file=sys.stderr)
+    timers = [StageTimer('read'), StageTimer('embed'), StageTimer('write')]
+    background = None
+    complete = False
+    start = time.perf_counter()
+    try:
+        with open(path, 'rb') as f:
+            records = fasta.parse_stream(f)
+            if not args.no_dedup:
+                # embed every distinct sequence once
+                dedup = Deduplicator()
+                records = dedup(records)
+            if args.resume:
+                # skip the sequences already written to every output or rejected
+                records = ((name,sequence) for name,sequence in records
+                           if name not in rejected
+                           and not all(name.decode('utf-8') in writers[pool] for pool in pools))
+            if args.pipeline:
+                records = read_ahead(records, queue_size, timers[0], timers[1])
+                background = BackgroundWriter(write, 16, timers[2], timers[1])
+            for name,z in embed_stream(model, records, pool=pools, use_cuda=use_cuda
+                                      , batch_size=args.batch_size, max_tokens=args.max_tokens
+                                      , window=args.window, overlap=args.overlap, max_memory=max_memory
+                                      , skip=skip, exact=args.exact_pooling):
+                if background is not None:
+                    background.put(name, z)
+                else:
+                    write(name, z)
+                count += 1
+                print('# {} sequences processed...'.format(count), file=sys.stderr, end='\r')
+            if background is not None:
+                background.close()
+                background = None
+        complete = True
+    finally:
+        try:
+            if background is not None:
+                background.close()
+        finally:
+            # close the outputs even when interrupted, so a later --resume can pick them up
+            for pool in pools:
+                writers[pool].close(complete=complete)
+            for f in rejects:
+                f.close()
+    elapsed = time.perf_counter() - start
     print(' '*80, file=sys.stderr, end='\r')
+    if len(rejected) > 0:
+        print('# skipped {} sequences, listed in {}'.format(len(rejected), rejects_path), file=sys.stderr)
+    if dedup is not None and dedup.unique > 0:
+        print('# {} unique of {} sequences, dedup ratio {:.2f}'.format(dedup.unique, dedup.total, dedup.total/dedup.unique), file=sys.stderr)
+    if args.pipeline:
+        # the model stage is busy whenever it isn't waiting on the reader or the writer
+        timers[1].busy = max(0.0, elapsed - timers[1].waiting)
+        utilization = ', '.join('{} {:.0%}'.format(t.name, t.utilization(elapsed)) for t in timers)
+        print('# stage utilization over {:.1f}s: {}'.format(elapsed, utilization), file=sys.stderr)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,188 @@
+from __future__ import print_function,division
+
+import os
+import sys
+import time
+import shutil
+import multiprocessing
+import numpy as np
+
+import prose.fasta as fasta
+from embed_sequences import load_model, embed_stream, output_paths, parse_pools, open_writer, LAYOUTS
+from prose.utils import DTYPES
+
+
+def balance_shards(lengths, n):
+    """ assign sequences to n shards with about the same number of residues,
+    longest sequences first, each one to the currently lightest shard """
+    shard = np.zeros(len(lengths), dtype=np.int64)
+    load = np.zeros(n, dtype=np.int64)
+    for i in np.argsort(lengths, kind='stable')[::-1]:
+        k = np.argmin(load)
+        shard[i] = k
+        load[k] += max(lengths[i], 1)
+    return shard, load
+
+
+def write_shards(path, shard, paths):
+    """ copy the records of the fasta file to one fasta file per shard """
+    files = [open(shard_path, 'wb') for shard_path in paths]
+    try:
+        with open(path, 'rb') as f:
+            for i,(name,sequence) in enumerate(fasta.parse_stream(f)):
+                files[shard[i]].write(b'>' + name + b'\n' + sequence + b'\n')
+    finally:
+        for f in files:
+            f.close()
+
+
+def shard_records(source, indices):
+    """ yield the records of one shard, fetched by position from an IndexedFasta
+    or parsed from the shard's own fasta file """
+    if isinstance(source, fasta.IndexedFasta):
+        for i in indices:
+            yield source.name(i), source[i]
+    else:
+        with open(source, 'rb') as f:
+            yield from fasta.parse_stream(f)
+
+
+def embed_shard(args):
+    """ embed one shard in a worker process and write it to part files, one per pool """
+    import torch
+
+    k, source, indices, options = args
+    torch.set_num_threads(options['threads'])
+    model = load_model(options['model'])
+    pools = options['pools']
+
+    h5 = {pool: open_writer(part_path(options['outputs'][pool], k), pool, layout=options['layout']) for pool in pools}
+    count = 0
+    start = time.time()
+    records = shard_records(source, indices)
+    for name,z in embed_stream(model, records, pool=pools
+                              , batch_size=options['batch_size'], max_tokens=options['max_tokens']
+                              ):
+        pid = name.decode('utf-8')
+        for pool in pools:
+            h5[pool].write(pid, z[pool])
+        count += 1
+    elapsed = time.time() - start
+    for pool in pools:
+        h5[pool].close(complete=True)
+
+    residues = int(options['load'][k])
+    return k, count, residues, elapsed
+
+
+def part_path(output, k):
+    return '{}.part{}'.format(output, k)
+
+
+def remove_part(path):
+    """ remove a part file, or directory with the store layout """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser('Embed a fasta file with several worker processes')
+
+    parser.add_argument('path')
+    parser.add_argument('-m', '--model', default='prose_mt', help='pretrained model to load, prose_mt loads the pretrained ProSE MT model, prose_dlm loads the pretrained Prose DLM model, otherwise unpickles torch model directly (default: prose_mt)')
+    parser.add_argument('-o', '--output')
+    parser.add_argument('--pool', type=parse_pools, default='none', help='pooling operation or comma separated list of them, see embed_sequences.py (default: none)')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='number of worker processes (default: number of cores)')
+    parser.add_argument('-t', '--threads', type=int, help='torch intra-op threads of every worker (default: cores/workers)')
+    parser.add_argument('--batch-size', type=int, default=1, help='embed up to this many sequences of similar length as one packed batch (default: 1)')
+    parser.add_argument('--max-tokens', type=int, help='maximum number of residues in one packed batch (default: no limit)')
+    parser.add_argument('--layout', choices=LAYOUTS, default='per-sequence', help='output layout, see embed_sequences.py (default: per-sequence)')
+    parser.add_argument('--dtype', choices=DTYPES, default='float32', help='storage precision of the embeddings, see embed_sequences.py (default: float32)')
+    parser.add_argument('--compression', choices=['gzip', 'lzf'], help='compress the output datasets (default: no compression)')
+
+    args = parser.parse_args()
+
+    path = args.path
+    workers = max(args.workers, 1)
+    threads = args.threads
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1)//workers)
+
+    pools = args.pool
+    outputs = output_paths(args.output, pools)
+
+    # index the sequences and balance the shards by residues. Workers read their
+    # sequences through the .fai index, or, when the file can't be indexed, from
+    # shard fasta files written here, so none of them parses the whole file
+    fa = None
+    try:
+        fa = fasta.IndexedFasta(path)
+        names = fa.names
+        lengths = fa.lengths
+    except (ValueError, OSError) as e:
+        print('# can\'t index {} ({}), writing shard fasta files'.format(path, e), file=sys.stderr)
+        names = []
+        lengths = []
+        with open(path, 'rb') as f:
+            for name,sequence in fasta.parse_stream(f):
+                names.append(name)
+                lengths.append(len(sequence))
+        lengths = np.array(lengths, dtype=np.int64)
+    workers = max(1, min(workers, len(names)))
+    shard, load = balance_shards(lengths, workers)
+    if fa is not None:
+        sources = [fa]*workers
+    else:
+        sources = [part_path(outputs[pools[0]], k) + '.fa' for k in range(workers)]
+        write_shards(path, shard, sources)
+    print('# embedding {} sequences, {} residues, with {} workers x {} threads'.format(len(names), lengths.sum(), workers, threads), file=sys.stderr)
+    options = {
+        'model': args.model,
+        'pools': pools,
+        'outputs': outputs,
+        'threads': threads,
+        'batch_size': args.batch_size,
+        'max_tokens': args.max_tokens,
+        'layout': args.layout,
+        'load': load,
+        }
+
+    # embed the shards in parallel
+    start = time.time()
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers) as pool:
+        jobs = [(k, sources[k], np.flatnonzero(shard == k), options) for k in range(workers)]
+        for k,count,residues,elapsed in pool.imap_unordered(embed_shard, jobs):
+            print('# worker {}: {} sequences, {} residues in {:.1f}s, {:.1f} residues/s'.format(k, count, residues, elapsed, residues/max(elapsed, 1e-9)), file=sys.stderr)
+    elapsed = time.time() - start
+    print('# embedded: {} sequences, {} residues in {:.1f}s, {:.1f} residues/s'.format(len(names), lengths.sum(), elapsed, lengths.sum()/max(elapsed, 1e-9)), file=sys.stderr)
+    if fa is None:
+        for source in sources:
+            os.remove(source)
+
+    # merge the parts in the order of the fasta file
+    merge_start = time.time()
+    for p in pools:
+        print('# writing:', outputs[p], file=sys.stderr)
+        parts = [open_writer(part_path(outputs[p], k), p, layout=args.layout, resume=True) for k in range(workers)]
+        writer = open_writer(outputs[p], p, layout=args.layout, compression=args.compression, dtype=args.dtype)
+        for i,name in enumerate(names):
+            pid = name.decode('utf-8')
+            writer.write(pid, parts[shard[i]][pid])
+        writer.close(complete=True)
+        for k in range(workers):
+            parts[k].close()
+            remove_part(part_path(outputs[p], k))
+    # the names are read from the mapped fasta file until here
+    if fa is not None:
+        fa.close()
+    merged = time.time() - merge_start
+    total = elapsed + merged
+    print('# merged in {:.1f}s, total: {:.1f}s, {:.1f} residues/s'.format(merged, total, lengths.sum()/max(total, 1e-9)), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
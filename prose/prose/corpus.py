@@ -0,0 +1,182 @@
+from __future__ import print_function,division
+
+import os
+import sys
+import json
+import numpy as np
+
+import torch
+
+from prose.alphabets import Uniprot21
+import prose.fasta as fasta
+import prose.scop as scop
+
+
+def residue_counts(xs, n):
+    """ number of times each of the n alphabet indices occurs in the encoded sequences xs """
+    counts = np.zeros(n, dtype=np.int64)
+    for x in xs:
+        counts += np.bincount(np.asarray(x), minlength=n)[:n]
+    return counts
+
+
+def load_counts(path, xs, alphabet, cache_path):
+    """ residue counts of the encoded sequences xs of fasta file path, cached in the
+    cache_path json file and counted again only when the fasta file, the alphabet or
+    the number of sequences changed """
+    stat = os.stat(path)
+    key = {'source': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime
+          , 'alphabet': alphabet.chars.tobytes().decode('ascii'), 'alphabet_size': len(alphabet)
+          , 'count': len(xs)}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            meta = json.load(f)
+        if all(meta.get(k) == v for k,v in key.items()):
+            return np.array(meta['counts'], dtype=np.int64)
+    print('# counting residues:', path, file=sys.stderr)
+    counts = residue_counts(xs, len(alphabet))
+    meta = dict(key, counts=counts.tolist())
+    with open(cache_path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(cache_path + '.tmp', cache_path)
+    return counts
+
+
+def build_corpus(path, cache_path, alphabet=Uniprot21(), astral=False):
+    """ encode the sequences of a fasta file once into a packed corpus directory.
+
+    The corpus holds the alphabet indices of all the sequences concatenated in
+    sequences.bin (uint8), their N+1 int64 offsets in offsets.bin, the names in names.txt,
+    one per line, the N+1 int64 offsets of the lines in name_offsets.bin, and meta.json with the residue counts used as the cloze noise
+    distribution. With astral, the names are parsed as SCOPe astral headers, the (N, 4)
+    int32 structure codes go to structs.bin and empty sequences are dropped, as
+    SCOPeDataset does. meta.json is written last, when the corpus is complete. """
+    print('# building packed corpus:', cache_path, file=sys.stderr)
+    os.makedirs(cache_path, exist_ok=True)
+    n = len(alphabet)
+    counts = np.zeros(n, dtype=np.int64)
+    total = 0
+    count = 0
+    name_total = 0
+    meta_path = os.path.join(cache_path, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    with open(path, 'rb') as f \
+        , open(os.path.join(cache_path, 'sequences.bin'), 'wb') as f_sequences \
+        , open(os.path.join(cache_path, 'offsets.bin'), 'wb') as f_offsets \
+        , open(os.path.join(cache_path, 'names.txt'), 'wb') as f_names \
+        , open(os.path.join(cache_path, 'name_offsets.bin'), 'wb') as f_name_offsets \
+        , open(os.path.join(cache_path, 'structs.bin'), 'wb') as f_structs:
+        f_offsets.write(np.zeros(1, dtype=np.int64).tobytes())
+        f_name_offsets.write(np.zeros(1, dtype=np.int64).tobytes())
+        for name,sequence in fasta.parse_stream(f):
+            if astral:
+                if len(sequence) == 0:
+                    continue
+                name,struct = scop.parse_astral_name(name)
+                f_structs.write(struct.astype(np.int32).tobytes())
+            x = alphabet.encode(sequence)
+            counts += np.bincount(x, minlength=n)[:n]
+            total += len(x)
+            count += 1
+            f_sequences.write(x.tobytes())
+            f_offsets.write(np.array([total], dtype=np.int64).tobytes())
+            f_names.write(name + b'\n')
+            name_total += len(name) + 1
+            f_name_offsets.write(np.array([name_total], dtype=np.int64).tobytes())
+
+    stat = os.stat(path)
+    meta = {'source': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime
+           , 'astral': astral, 'alphabet': alphabet.chars.tobytes().decode('ascii'), 'alphabet_size': n
+           , 'count': count, 'residues': total, 'name_bytes': name_total, 'counts': counts.tolist()}
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+class CorpusNames:
+    """ names of the sequences of a PackedCorpus, sliced from the mapped names.txt on
+    access instead of being held as one bytes object each """
+    def __init__(self, names, offsets):
+        self.names = names
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        # drop the newline
+        return self.names[self.offsets[i]:self.offsets[i+1]-1].tobytes()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class PackedCorpus:
+    """ memory map of a packed corpus written by build_corpus.
+
+    corpus[i] is a uint8 tensor of the alphabet indices of sequence i, sliced from the
+    mapped buffer without copying. The buffer is mapped copy-on-write, so DataLoader
+    workers share its pages through the OS page cache and the file is never modified. """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        count = self.meta['count']
+        self.sequences = self._map('sequences.bin', np.uint8, (self.meta['residues'],))
+        self.offsets = self._map('offsets.bin', np.int64, (count + 1,))
+        self.lengths = np.diff(self.offsets)
+        name_offsets = self._map('name_offsets.bin', np.int64, (count + 1,))
+        self.names = CorpusNames(self._map('names.txt', np.uint8, (self.meta['name_bytes'],)), name_offsets)
+        self.structs = None
+        if self.meta['astral']:
+            self.structs = self._map('structs.bin', np.int32, (count, 4))
+        self.counts = np.array(self.meta['counts'], dtype=np.float64)
+
+    def _map(self, name, dtype, shape):
+        if shape[0] == 0:
+            # empty files can't be mapped
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode='c', shape=shape)
+
+    @property
+    def noise(self):
+        """ amino acid marginal distribution of the corpus """
+        return self.counts/self.counts.sum()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        start,end = self.offsets[i],self.offsets[i+1]
+        return torch.from_numpy(np.asarray(self.sequences[start:end]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def load_corpus(path, alphabet=Uniprot21(), astral=False, cache_path=None):
+    """ packed corpus of a fasta file, cached in <path>.corpus. It is built on first use
+    and again whenever the fasta file changed since """
+    if cache_path is None:
+        cache_path = path + '.corpus'
+    meta_path = os.path.join(cache_path, 'meta.json')
+    stale = True
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        stat = os.stat(path)
+        # corpora written before the name offsets were added are built again
+        stale = ('name_bytes' not in meta
+                 or meta['size'] != stat.st_size or meta['mtime'] != stat.st_mtime
+                 or meta['astral'] != astral
+                 or meta['alphabet'] != alphabet.chars.tobytes().decode('ascii')
+                 or meta['alphabet_size'] != len(alphabet))
+    if stale:
+        build_corpus(path, cache_path, alphabet=alphabet, astral=astral)
+    print('# mapping packed corpus:', cache_path, file=sys.stderr)
+    return PackedCorpus(cache_path)
@@ -18,20 +18,28 @@ import torch
 from prose.alphabets import Uniprot21
 import prose.scop as scop
 import prose.fasta as fasta
+from prose.corpus import load_corpus, load_counts, residue_counts
 
 
 class SCOPeDataset:
     def __init__(self, path='data/SCOPe/astral-scopedom-seqres-gd-sel-gs-bib-95-2.06.train.fa'
-                , alphabet=Uniprot21(), augment=None):
+                , alphabet=Uniprot21(), augment=None, cache=False):
         print('# loading SCOP sequences:', path, file=sys.stderr)
 
         self.augment = augment
 
-        names, structs, sequences = self.load(path, alphabet)
-            
-        self.names = names
-        self.x = [torch.from_numpy(x) for x in sequences]
-        self.y = torch.from_numpy(structs)
+        if cache:
+            # memory map the packed corpus instead of parsing the fasta file
+            corpus = load_corpus(path, alphabet=alphabet, astral=True)
+            self.names = corpus.names
+            self.x = corpus
+            self.y = torch.from_numpy(np.asarray(corpus.structs))
+        else:
+            names, structs, sequences = self.load(path, alphabet)
+
+            self.names = names
+            self.x = [torch.from_numpy(x) for x in sequences]
+            self.y = torch.from_numpy(structs)
 
         print('# loaded', len(self.x), 'sequences', file=sys.stderr)
 
@@ -193,10 +201,61 @@ class ContactMapDataset:
         return x, y
 
 
+class EncodedFasta:
+    """ alphabet indices of the sequences of an IndexedFasta, encoded on access """
+    def __init__(self, fa, alphabet, size=None):
+        self.fasta = fa
+        self.alphabet = alphabet
+        self.size = len(fa) if size is None else size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if i >= self.size:
+            raise IndexError(i)
+        return self.fetch(i)
+
+    def fetch(self, i, start=0, end=None):
+        return torch.from_numpy(self.alphabet.encode(self.fasta.fetch(i, start, end)))
+
+
 class FastaDataset:
-    def __init__(self, path, max_length=0, alphabet=Uniprot21(), debug=False):
+    def __init__(self, path, max_length=0, alphabet=Uniprot21(), debug=False, cache=False, lazy=False):
 
         print('# loading fasta sequences:', path, file=sys.stderr)
+        self.max_length = max_length
+        self.lazy = False
+
+        if cache and not debug:
+            # memory map the packed corpus instead of parsing the fasta file,
+            # its noise distribution was counted when it was built
+            corpus = load_corpus(path, alphabet=alphabet)
+            self.names = corpus.names
+            self.x = corpus
+            self.lengths = corpus.lengths
+            self.noise = corpus.noise
+            print('# loaded', len(self.x), 'sequences', file=sys.stderr)
+            return
+
+        if lazy:
+            # read the sequences and names from the indexed fasta file on demand, worker
+            # processes share the mapped file and index through the page cache
+            fa = fasta.IndexedFasta(path)
+            n = len(fa)
+            if debug:
+                n = min(n, 10001)
+            self.lazy = True
+            self.names = fa.names
+            self.x = EncodedFasta(fa, alphabet, size=n)
+            self.lengths = fa.lengths[:n]
+            # the noise distribution is counted in one streaming pass, then cached
+            # next to the index
+            counts = load_counts(path, self.x, alphabet, path + '.fai.counts.json').astype(np.float64)
+            self.noise = counts/counts.sum()
+            print('# indexed', len(self.x), 'sequences', file=sys.stderr)
+            return
+
         with open(path, 'rb') as f:
             if debug:
                 count = 0
@@ -213,8 +272,11 @@ class FastaDataset:
 
         self.names = names
         self.x = [torch.from_numpy(alphabet.encode(s)) for s in sequences]
+        self.lengths = np.array([len(x) for x in self.x])
 
-        self.max_length = max_length
+        # amino acid marginal distribution, used as the cloze noise distribution
+        counts = residue_counts(self.x, len(alphabet)).astype(np.float64)
+        self.noise = counts/counts.sum()
 
         print('# loaded', len(self.x), 'sequences', file=sys.stderr)
 
@@ -224,8 +286,16 @@ class FastaDataset:
 
 
     def __getitem__(self, i):
-        x = self.x[i]
         max_length = self.max_length
+        if self.lazy:
+            # only read the subsequence that is kept
+            n = int(self.lengths[i])
+            if max_length > 0 and n > max_length:
+                j = random.randint(0, n - max_length)
+                return self.x.fetch(i, j, j+max_length).long()
+            return self.x.fetch(i).long()
+
+        x = self.x[i]
         if max_length > 0 and len(x) > max_length:
             # randomly sample a subsequence of length max_length
             j = random.randint(0, len(x) - max_length)
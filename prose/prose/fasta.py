@@ -1,5 +1,10 @@
 from __future__ import print_function, division
 
+import os
+import mmap
+import array
+import numpy as np
+
 def parse_stream(f, comment=b'#'):
     name = None
     sequence = []
@@ -39,3 +44,194 @@ def parse(f, comment=b'#'):
         sequences.append(b''.join(sequence))
 
     return names, sequences
+
+
+def build_index(f):
+    """ scan a fasta file opened in binary mode, returns the (N, 6) int64 index rows: the
+    (length, offset, line bases, line width) of every sequence as in samtools .fai indices,
+    followed by the offset and length of its name (the full header without the '>') in the
+    file. Raises ValueError when the sequence lines of a record aren't all of the same
+    width, except the last one, or on comment lines. """
+    rows = array.array('q')
+    offset = 0
+    name = None
+    row = None
+    short = False
+    for line in f:
+        if line.startswith(b'>'):
+            if row is not None:
+                rows.extend(row)
+            name = line[1:].rstrip(b'\r\n')
+            row = [0, offset + len(line), 0, 0, offset + 1, len(name)]
+            short = False
+        elif line.startswith(b'#'):
+            raise ValueError('comment lines can\'t be indexed, at byte {}'.format(offset))
+        elif row is not None:
+            bases = len(line.rstrip(b'\r\n'))
+            if bases > 0:
+                # only the last line of a record may be shorter, only the last line of
+                # the file may miss its newline
+                width = row[3] if bases == row[2] and len(line) == bases else len(line)
+                if short or (row[2] > 0 and (bases > row[2] or (bases == row[2] and width != row[3]))):
+                    raise ValueError('sequence lines of different widths in record {}'.format(name.decode('utf-8', 'replace')))
+                if row[2] == 0:
+                    row[2] = bases
+                    row[3] = len(line)
+                row[0] += bases
+            if bases < row[2] or bases == 0 or len(line) == bases:
+                short = True
+        offset += len(line)
+    if row is not None:
+        rows.extend(row)
+    if len(rows) == 0:
+        return np.zeros((0, 6), dtype=np.int64)
+    return np.frombuffer(rows, dtype=np.int64).reshape(-1, 6)
+
+
+def read_names(f, rows):
+    """ yield the names of the index rows from the fasta file opened in binary mode """
+    for offset,length in rows[:,4:6]:
+        f.seek(offset)
+        yield f.read(length)
+
+
+def write_index(path, rows, names):
+    """ write the samtools compatible .fai index and the binary <path>.bin copy of the
+    rows that is memory mapped when the index is read. The binary file goes last, it
+    marks the index as complete. """
+    with open(path + '.tmp', 'wb') as f:
+        for name,(length,offset,bases,width) in zip(names, rows[:,:4]):
+            f.write(b'%s\t%d\t%d\t%d\t%d\n' % (name, length, offset, bases, width))
+    os.replace(path + '.tmp', path)
+    with open(path + '.bin.tmp', 'wb') as f:
+        f.write(np.ascontiguousarray(rows, dtype=np.int64).tobytes())
+    os.replace(path + '.bin.tmp', path + '.bin')
+
+
+def read_index(path):
+    """ memory map the (N, 6) index rows of <path>.bin """
+    path = path + '.bin'
+    n = os.path.getsize(path)//48
+    if n == 0:
+        # empty files can't be mapped
+        return np.zeros((0, 6), dtype=np.int64)
+    return np.memmap(path, dtype=np.int64, mode='r', shape=(n, 6))
+
+
+def load_index(path, index_path=None):
+    """ read the index of a fasta file, building it first when there is none or the
+    fasta file changed since """
+    if index_path is None:
+        index_path = path + '.fai'
+    if os.path.exists(index_path + '.bin') and os.path.getmtime(index_path + '.bin') >= os.path.getmtime(path):
+        return read_index(index_path)
+    with open(path, 'rb') as f:
+        rows = build_index(f)
+        write_index(index_path, rows, read_names(f, rows))
+    return read_index(index_path)
+
+
+class FastaNames:
+    """ names of the sequences of an IndexedFasta, read from the mapped file on access
+    instead of being held in memory """
+    def __init__(self, fa):
+        self.fasta = fa
+
+    def __len__(self):
+        return len(self.fasta)
+
+    def __getitem__(self, i):
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        return self.fasta.name(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.fasta.name(i)
+
+
+class IndexedFasta:
+    """ random access to the sequences of a fasta file through its cached index and a
+    memory map of the file. fa[i] and fa[name] return the upper case sequence bytes,
+    iterating yields (name, sequence) like parse_stream. The index rows are memory
+    mapped as well and names are read from the file when needed, so the sequences
+    and names take no memory of their own. """
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path
+        self._open()
+
+    def _open(self):
+        self.rows = load_index(self.path, index_path=self.index_path)
+        self.lengths = self.rows[:,0]
+        self.offsets = self.rows[:,1]
+        self.line_bases = self.rows[:,2]
+        self.line_widths = self.rows[:,3]
+        self._index = None
+
+        self.file = open(self.path, 'rb')
+        self.mm = None
+        if os.path.getsize(self.path) > 0:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def names(self):
+        return FastaNames(self)
+
+    def name(self, i):
+        """ name of sequence i """
+        offset,length = int(self.rows[i,4]),int(self.rows[i,5])
+        return self.mm[offset:offset+length]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, (bytes, str)):
+            i = self.index(i)
+        return self.fetch(i)
+
+    def fetch(self, i, start=0, end=None):
+        """ residues start to end of sequence i, reading only that part of the file """
+        length = int(self.lengths[i])
+        if end is None or end > length:
+            end = length
+        if start >= end:
+            return b''
+        offset = int(self.offsets[i])
+        bases = int(self.line_bases[i])
+        width = int(self.line_widths[i])
+        first = offset + (start//bases)*width + start%bases
+        last = offset + ((end-1)//bases)*width + (end-1)%bases
+        return self.mm[first:last+1].translate(None, b'\r\n').upper()
+
+    def index(self, name):
+        """ position of the sequence with the given name """
+        if isinstance(name, str):
+            name = name.encode('utf-8')
+        if self._index is None:
+            self._index = {name: i for i,name in enumerate(self.names)}
+        return self._index[name]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.name(i), self[i]
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.file.close()
+
+    def __getstate__(self):
+        # the index and the file are mapped again when unpickled, e.g. in spawned workers
+        return {'path': self.path, 'index_path': self.index_path}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
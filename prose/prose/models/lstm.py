@@ -2,7 +2,7 @@ from __future__ import print_function,division
 
 import torch
 import torch.nn as nn
-from torch.nn.utils.rnn import PackedSequence
+from torch.nn.utils.rnn import PackedSequence, pad_packed_sequence
 
 import os
 from prose.utils import get_project_root
@@ -70,6 +70,52 @@ class SkipLSTM(nn.Module):
             h = torch.cat([z for z in hs], 2)
         return h
 
+    def transform_pooled(self, x, pools=('avg',)):
+        """ transform and reduce over the sequence positions, returns a dict of (batch, n)
+        tensors keyed by pooling operation (sum, max or avg). Each layer block is reduced as
+        soon as it is computed and then released, so the concatenated per-residue tensor
+        is never built. """
+        one_hot = self.to_one_hot(x)
+        zs = {pool: [] for pool in pools}
+        self._pool_block(one_hot, pools, zs)
+        h_ = one_hot
+        for f in self.layers:
+            h,_ = f(h_)
+            self._pool_block(h, pools, zs)
+            h_ = h
+        return {pool: torch.cat(zs[pool], 1) for pool in pools}
+
+    @staticmethod
+    def _pool_block(h, pools, zs):
+        packed = type(h) is PackedSequence
+        if packed:
+            # padded positions are zero, so they don't change the sums
+            z,lengths = pad_packed_sequence(h, batch_first=True)
+            lengths = lengths.to(device=z.device, dtype=z.dtype).unsqueeze(1)
+        else:
+            z = h
+            lengths = z.new_full((z.size(0), 1), z.size(1))
+
+        total = None
+        if 'sum' in pools or 'avg' in pools:
+            total = z.sum(1)
+        for pool in pools:
+            if pool == 'sum':
+                zs[pool].append(total)
+            elif pool == 'avg':
+                zs[pool].append(total/lengths)
+            elif pool == 'max':
+                if packed:
+                    # mask the padded positions of the tensor unpacked above
+                    steps = torch.arange(z.size(1), device=z.device).unsqueeze(0)
+                    padding = (steps >= lengths).unsqueeze(2)
+                    z_max,_ = z.masked_fill(padding, float('-inf')).max(1)
+                else:
+                    z_max,_ = z.max(1)
+                zs[pool].append(z_max)
+            else:
+                raise ValueError('unknown pooling operation: ' + pool)
+
     def forward(self, x):
         one_hot = self.to_one_hot(x)
         hs = [one_hot]
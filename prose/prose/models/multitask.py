@@ -48,6 +48,9 @@ class ProSEMT(nn.Module):
     def transform(self, x):
         return self.embedding.transform(x)
 
+    def transform_pooled(self, x, pools=('avg',)):
+        return self.embedding.transform_pooled(x, pools=pools)
+
     def score(self, z_x, z_y):
         return self.scop_predict(z_x, z_y)
 
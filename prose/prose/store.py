@@ -0,0 +1,207 @@
+from __future__ import print_function,division
+
+import os
+import json
+import numpy as np
+
+from prose.utils import quantize, dequantize
+
+
+class ResidueStore:
+    """ memory-mapped per-residue embeddings of many sequences.
+
+    A store is a directory holding the (total_residues, D) residues.bin matrix with the
+    per-residue embeddings of all the sequences concatenated, offsets.bin with the N+1
+    int64 offsets of the sequences in it, ids.txt with the sequence ids, one per line,
+    and meta.json. int8 stores also hold the (total_residues,) float32 scales.bin.
+
+    store[i] and store[pid] return the (L, D) view of one sequence, store[i:j] the
+    view of consecutive sequences together with their offsets into it, nothing is copied.
+    Use embedding to get float32 embeddings of float16 and int8 stores. """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.dim = self.meta['dim']
+        self.dtype = self.meta['dtype']
+        n = self.meta['count']
+        total = self.meta['residues']
+
+        self.offsets = self._map('offsets.bin', np.int64, (n + 1,))
+        self.residues = self._map('residues.bin', self.dtype, (total, self.dim))
+        self.scales = None
+        if self.dtype == 'int8':
+            self.scales = self._map('scales.bin', np.float32, (total,))
+        with open(os.path.join(path, 'ids.txt')) as f:
+            self.ids = f.read().splitlines()[:n]
+        self.index = {pid: i for i,pid in enumerate(self.ids)}
+
+    def _map(self, name, dtype, shape):
+        if shape[0] == 0:
+            # empty files can't be mapped
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r', shape=shape)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, pid):
+        return pid in self.index
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start,stop,step = i.indices(len(self))
+            if step != 1:
+                raise ValueError('only consecutive sequences can be viewed together')
+            stop = max(start, stop)
+            offsets = self.offsets[start:stop+1]
+            return self.residues[offsets[0]:offsets[-1]], offsets - offsets[0]
+        if isinstance(i, str):
+            i = self.index[i]
+        # negative positions count from the end, out of range ones raise IndexError
+        i = range(len(self))[i]
+        return self.residues[self.offsets[i]:self.offsets[i+1]]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def batch(self, indices):
+        """ views of the sequences with the given positions or ids """
+        return [self[i] for i in indices]
+
+    def embedding(self, i):
+        """ float32 (L, D) embedding of sequence i (position or id) """
+        if isinstance(i, str):
+            i = self.index[i]
+        i = range(len(self))[i]
+        start,end = self.offsets[i],self.offsets[i+1]
+        scale = None
+        if self.scales is not None:
+            scale = self.scales[start:end]
+        return dequantize(self.residues[start:end], scale)
+
+
+class ResidueStoreWriter:
+    """ writes per-residue embeddings to a ResidueStore directory.
+
+    The matrix, offsets and ids are appended to as sequences are written. meta.json holds
+    the number of complete sequences and is rewritten every flush_interval sequences (or
+    64MB), so with resume everything written after the last flush is dropped and the ids
+    already written can be skipped. Duplicates are written as copies. """
+    max_buffer = 2**26
+
+    def __init__(self, path, resume=False, flush_interval=1000, dtype='float32'):
+        self.path = path
+        self.dtype = dtype
+        self.flush_interval = flush_interval
+        os.makedirs(path, exist_ok=True)
+
+        count, total, dim = 0, 0, None
+        meta_path = os.path.join(path, 'meta.json')
+        if resume and os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta['dtype'] != dtype:
+                raise ValueError('{} holds {} embeddings, not {}'.format(path, meta['dtype'], dtype))
+            count, total, dim = meta['count'], meta['residues'], meta['dim']
+        self.dim = dim
+        self.itemsize = np.dtype(dtype).itemsize
+
+        # drop whatever was written after the last flush
+        self.ids = []
+        if count > 0:
+            with open(os.path.join(path, 'ids.txt')) as f:
+                self.ids = f.read().splitlines()[:count]
+        self.index = {pid: i for i,pid in enumerate(self.ids)}
+        mode = 'r+b' if count > 0 else 'w+b'
+        self.residues = open(os.path.join(path, 'residues.bin'), mode)
+        self.residues.truncate(total*(dim or 0)*self.itemsize)
+        self.offsets = open(os.path.join(path, 'offsets.bin'), mode)
+        if count == 0:
+            self.offsets.write(np.zeros(1, dtype=np.int64).tobytes())
+        self.offsets.truncate((count + 1)*8)
+        self.scales = None
+        if dtype == 'int8':
+            self.scales = open(os.path.join(path, 'scales.bin'), mode)
+            self.scales.truncate(total*4)
+        self.ids_file = open(os.path.join(path, 'ids.txt'), 'w')
+        self.ids_file.writelines(pid + '\n' for pid in self.ids)
+        for f in self.files():
+            f.seek(0, os.SEEK_END)
+
+        self.resumed = count
+        self.total = total
+        self.complete = False
+        self.pending = 0
+        self.buffered = 0
+        if count == 0:
+            self.write_meta()
+
+    def files(self):
+        files = [self.residues, self.offsets, self.ids_file]
+        if self.scales is not None:
+            files.append(self.scales)
+        return files
+
+    def __contains__(self, pid):
+        return pid in self.index
+
+    def __getitem__(self, pid):
+        i = self.index[pid]
+        for f in self.files():
+            f.flush()
+        offsets = np.memmap(self.offsets.name, dtype=np.int64, mode='r', offset=i*8, shape=(2,))
+        start,end = int(offsets[0]),int(offsets[1])
+        residues = np.memmap(self.residues.name, dtype=self.dtype, mode='r'
+                            , offset=start*self.dim*self.itemsize, shape=(end - start, self.dim))
+        scale = None
+        if self.scales is not None:
+            scale = np.memmap(self.scales.name, dtype=np.float32, mode='r', offset=start*4, shape=(end - start,))
+        return dequantize(residues, scale)
+
+    def write(self, pid, z):
+        z = z.reshape(-1, z.shape[-1])
+        if self.dim is None:
+            self.dim = z.shape[1]
+        q,scale = quantize(z, self.dtype)
+        self.residues.write(q.tobytes())
+        if scale is not None:
+            self.scales.write(scale.tobytes())
+        self.offsets.write(np.array([self.total + len(q)], dtype=np.int64).tobytes())
+        self.ids_file.write(pid + '\n')
+        self.index[pid] = len(self.ids)
+        self.ids.append(pid)
+        self.total += len(q)
+
+        self.pending += 1
+        self.buffered += q.nbytes
+        full = self.flush_interval > 0 and self.pending >= self.flush_interval
+        if full or self.buffered >= self.max_buffer:
+            self.flush()
+
+    def link(self, pid, source):
+        """ store a copy of the embedding already written for source under pid """
+        self.write(pid, self[source])
+
+    def write_meta(self):
+        meta = {'dim': self.dim or 0, 'dtype': self.dtype, 'count': len(self.ids)
+               , 'residues': self.total, 'complete': self.complete}
+        path = os.path.join(self.path, 'meta.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(path + '.tmp', path)
+
+    def flush(self):
+        # the data has to be on disk before the meta data counts it
+        for f in self.files():
+            f.flush()
+            os.fsync(f.fileno())
+        self.write_meta()
+        self.pending = 0
+        self.buffered = 0
+
+    def close(self, complete=False):
+        self.complete = complete
+        self.flush()
+        for f in self.files():
+            f.close()
@@ -56,6 +56,32 @@ def unpack_sequences(X, order):
     return X_block
 
 
+DTYPES = ['float32', 'float16', 'int8']
+
+
+def quantize(z, dtype='float32'):
+    """ convert (..., D) embeddings to a storage dtype. int8 scales every D-vector by its
+    largest absolute value, returns (q, scale) with scale of shape z.shape[:-1], or None
+    for the float dtypes """
+    z = np.asarray(z, dtype=np.float32)
+    if dtype == 'int8':
+        scale = (np.abs(z).max(-1)/127).astype(np.float32)
+        safe = np.where(scale > 0, scale, 1)
+        q = np.clip(np.rint(z/safe[...,None]), -127, 127).astype(np.int8)
+        return q, scale
+    if dtype not in DTYPES:
+        raise ValueError('unknown storage dtype: ' + dtype)
+    return z.astype(dtype), None
+
+
+def dequantize(q, scale=None):
+    """ float32 embeddings from the output of quantize """
+    z = np.asarray(q).astype(np.float32)
+    if scale is not None:
+        z *= np.asarray(scale, dtype=np.float32).reshape(z.shape[:-1] + (1,))
+    return z
+
+
 def infinite_iterator(it):
     while True:
         for x in it:
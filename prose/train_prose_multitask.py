@@ -360,6 +360,10 @@ def main():
     parser.add_argument('--save-prefix', help='path prefix for saving models')
     parser.add_argument('-d', '--device', type=int, default=-2, help='compute device to use')
 
+    parser.add_argument('--cache', action='store_true', help='encode the training sequences once into a packed corpus next to each fasta file (<path>.corpus) and memory map it in later runs')
+
+    parser.add_argument('--lazy', action='store_true', help='read the cloze training sequences on demand from the fasta file through its .fai index instead of loading them into memory')
+
     parser.add_argument('--debug', action='store_true')
 
     args = parser.parse_args()
@@ -377,7 +381,7 @@ def main():
 
     # 1. SCOPe structural similarity
     path='data/SCOPe/astral-scopedom-seqres-gd-sel-gs-bib-95-2.06.train.fa'
-    scop_train = SCOPeDataset(path=path)
+    scop_train = SCOPeDataset(path=path, cache=args.cache)
     scop_test = SCOPePairsDataset()
 
     # 2. contact maps
@@ -400,15 +404,13 @@ def main():
 
         fasta_train = FastaDataset(path, max_length=max_length
                                   , debug=args.debug
+                                  , cache=args.cache
+                                  , lazy=args.lazy
                                   )
 
-        # calculate the distribution over the amino acids
+        # the distribution over the amino acids
         # to use as the noise distribution
-        counts = np.zeros(21)
-        for x in fasta_train.x:
-            v,c = np.unique(x.numpy(), return_counts=True)
-            counts[v] = counts[v] + c
-        noise = counts/counts.sum()
+        noise = fasta_train.noise
         print('# amino acid marginal distribution:', noise, file=sys.stderr)
         noise = torch.from_numpy(noise)
         p = args.p
@@ -491,7 +493,7 @@ def main():
         batch_size = args.cloze_batch_size
 
         # weight each sequence by the number of fragments
-        L = np.array([len(x) for x in fasta_train.x])
+        L = fasta_train.lengths
         weight = np.maximum(L/max_length, 1)
         sampler = LargeWeightedRandomSampler(weight, batch_size*num_steps)
 
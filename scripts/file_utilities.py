@@ -1,17 +1,31 @@
 # Collection of file utilities
 #    file_paths - prepare paths for files and folders
 #    convert_h5_to_pt - convert h5 files to pt files
+#    quantize, dequantize - store embeddings as float16 or int8 and read them back as float32 (from prose.utils)
+#    store_paths - paths of the feature store files
+#    convert_h5_to_store - convert h5 files to a feature store
+#    convert_pt_to_store - convert pt files to a feature store
 #    emb_files_stats - prints stats for embedding folders
-#    read_embeddings - read embeddings from pt files
+#    read_embeddings - read embeddings from a feature store or pt files
 #    check_with_df - check our data using DataFrame displaying few rows only
 
 # Import dependencies
 import os
+import sys
+import json
 import h5py
+import numpy as np
 import torch
 import esm
 import pandas as pd
 
+# Embeddings are stored and read back with the storage precisions of the
+# ProSE repository, which sits next to the scripts
+PROSE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'prose')
+if PROSE_DIR not in sys.path:
+    sys.path.insert(0, PROSE_DIR)
+from prose.utils import DTYPES, quantize, dequantize
+
 # Prepare file paths
 def file_paths(ptmodel, task, file_base, model, pool, data_folder = '../../data'):
     """ Prepare paths for files and folders
@@ -91,6 +105,33 @@ def file_paths(ptmodel, task, file_base, model, pool, data_folder = '../../data'
     return path_pt, path_h5, path_fa
 
 
+# Group of the int8 scales in h5 files with one dataset per sequence
+H5_SCALES = 'scales'
+
+# Ids of the sequences in an h5 file with one dataset per sequence
+def h5_keys(hf):
+    return [key for key in hf.keys() if key != H5_SCALES]
+
+# Reads one sequence embedding of an h5 file as float32
+def read_h5_embedding(hf, key):
+    """ Read a sequence embedding from an h5 file with one dataset per sequence
+
+    Embeddings stored as float16 or int8 are converted back to float32, the
+    scales of int8 embeddings are read from the scales group (or the 'scale'
+    attribute of files written before it)
+
+    Args:
+        hf: open h5 file
+        key: sequence id
+
+    Returns:
+        X: float32 embedding
+    """
+    scale = hf[key].attrs.get('scale')
+    if H5_SCALES in hf and key in hf[H5_SCALES]:
+        scale = hf[H5_SCALES][key][()]
+    return dequantize(hf[key][:], scale)
+
 # Converts h5 file to pt files, one per each sequence embedding.
 def convert_h5_to_pt(path_h5, path_pt, pool):
     """ Convert h5 files to pt files (used for prose only)
@@ -106,13 +147,149 @@ def convert_h5_to_pt(path_h5, path_pt, pool):
     os.makedirs(path_pt, exist_ok=True)
     with h5py.File(path_h5, 'r') as hf:
         dd = {}
-        for key in hf.keys():
+        for key in h5_keys(hf):
             
             dd['label'] = key
-            t = torch.tensor(hf.get(key))
+            # Embeddings stored as float16 or int8 are converted back to float32
+            t = torch.tensor(read_h5_embedding(hf, key))
             dd[f'{pool}_representations'] = {'layer': t}
             torch.save(dd, f'{os.path.join(path_pt, key)}.pt')
  
+# Paths of the feature store kept next to the pt files folder
+def store_paths(path_pt):
+    """ Paths of the feature store files for an embeddings folder
+
+    The feature store holds all the embeddings of a folder as one contiguous
+    (N, D) .npy matrix, an id index with the fasta header (without '>')
+    of every row, one per line, and a JSON metadata sidecar written last.
+    int8 stores also hold the (N,) scales of the rows.
+
+    Args:
+        path_pt: path to pt files folder
+
+    Returns:
+        path_npy: path to the embedding matrix
+        path_ids: path to the id index
+        path_meta: path to the metadata sidecar
+        path_scale: path to the row scales (int8 only)
+    """
+    path_pt = path_pt.rstrip(os.sep)
+    return f'{path_pt}.npy', f'{path_pt}.ids', f'{path_pt}.json', f'{path_pt}.scale.npy'
+
+
+# Writes the rows returned by a function to a feature store, in the given order
+def write_store(path_pt, ids, read_row, meta, dtype='float32'):
+    """ Write a feature store
+
+    Args:
+        path_pt: path to pt files folder the store belongs to
+        ids: fasta headers (without '>') in row order
+        read_row: function returning the embedding of an id as an array
+        meta: dictionary of metadata saved in the sidecar
+        dtype: storage precision - ['float32', 'float16', 'int8']
+    """
+    path_npy, path_ids, path_meta, path_scale = store_paths(path_pt)
+    # The store is incomplete until the new sidecar is in place
+    if os.path.exists(path_meta):
+        os.remove(path_meta)
+    X = None
+    scales = np.ones(len(ids), dtype=np.float32)
+    for i, key in enumerate(ids):
+        x, scale = quantize(np.reshape(read_row(key), -1), dtype)
+        if X is None:
+            # Write to temporary files and move them in place when complete
+            X = np.lib.format.open_memmap(f'{path_npy}.tmp', mode='w+', dtype=x.dtype,
+                                          shape=(len(ids), len(x)))
+        X[i] = x
+        if scale is not None:
+            scales[i] = scale
+    if X is None:
+        X = np.zeros((0, 0), dtype=dtype)
+        with open(f'{path_npy}.tmp', 'wb') as f:
+            np.save(f, X)
+    else:
+        X.flush()
+    shape = X.shape
+    del X
+    with open(f'{path_ids}.tmp', 'w') as f:
+        f.writelines(f'{key}\n' for key in ids)
+    os.replace(f'{path_npy}.tmp', path_npy)
+    os.replace(f'{path_ids}.tmp', path_ids)
+    if dtype == 'int8':
+        with open(f'{path_scale}.tmp', 'wb') as f:
+            np.save(f, scales)
+        os.replace(f'{path_scale}.tmp', path_scale)
+
+    meta = dict(meta, shape=list(shape), dtype=dtype)
+    with open(f'{path_meta}.tmp', 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(f'{path_meta}.tmp', path_meta)
+
+
+# Fasta headers (without '>') in file order
+def fasta_ids(path_fa):
+    return [header[1:] for header, _seq in esm.data.read_fasta(path_fa)]
+
+
+# Converts h5 file to a feature store
+def convert_h5_to_store(path_h5, path_pt, pool, path_fa=None, dtype='float32'):
+    """ Convert h5 files to a feature store (used for prose only)
+
+    Both the per-sequence and the consolidated layout of embed_sequences.py
+    are supported.
+
+    Args:
+        path_h5: path to h5 files
+        path_pt: path to pt files folder the store belongs to
+        pool: pooling operation
+        path_fa: path to fasta file, rows are stored in its order so they
+                 can be read back without copying (default: h5 order)
+        dtype: storage precision - ['float32', 'float16', 'int8']
+
+    Returns:
+        Saving the feature store files
+    """
+    with h5py.File(path_h5, 'r') as hf:
+        if hf.attrs.get('layout') == 'consolidated':
+            keys = [k.decode('utf-8') if isinstance(k, bytes) else k for k in hf['ids'][:]]
+            rows = {k: i for i, k in enumerate(keys)}
+            scales = hf['scales'][:] if 'scales' in hf else None
+            embeddings = dequantize(hf['embeddings'][:], scales)
+            read_row = lambda key: embeddings[rows[key]]
+        else:
+            keys = h5_keys(hf)
+            read_row = lambda key: read_h5_embedding(hf, key)
+        ids = fasta_ids(path_fa) if path_fa is not None else keys
+        meta = {'source': 'prose', 'pool': pool, 'layer': 'layer', 'h5': os.path.basename(path_h5)}
+        write_store(path_pt, ids, read_row, meta, dtype)
+
+
+# Converts a folder of pt files to a feature store
+def convert_pt_to_store(path_pt, pool, emb_layer, path_fa=None, dtype='float32'):
+    """ Convert pt files to a feature store (esm or converted prose)
+
+    Args:
+        path_pt: path to pt files folder
+        pool: pooling operation
+        emb_layer: layer from which embeddings are extracted,
+                   for prose we are using string 'layer'
+        path_fa: path to fasta file, rows are stored in its order so they
+                 can be read back without copying (default: file name order)
+        dtype: storage precision - ['float32', 'float16', 'int8']
+
+    Returns:
+        Saving the feature store files
+    """
+    if path_fa is not None:
+        ids = fasta_ids(path_fa)
+    else:
+        ids = sorted(f[:-3] for f in os.listdir(path_pt) if f.endswith('.pt'))
+    read_row = lambda key: torch.load(f'{os.path.join(path_pt, key)}.pt')[f'{pool}_representations'][emb_layer].numpy()
+    source = 'prose' if emb_layer == 'layer' else 'esm'
+    meta = {'source': source, 'pool': pool, 'layer': emb_layer}
+    write_store(path_pt, ids, read_row, meta, dtype)
+
+
 # Prints the total size and number of pt files in embedding folders
 def emb_files_stats(path_pt):
     """ Prints stats for embedding folders
@@ -139,9 +316,15 @@ def emb_files_stats(path_pt):
         j += 1
         
 
-# Extract embeddings, target labels, sequential ids from pt files
+# Extract embeddings, target labels, sequential ids from a feature store or pt files
 def read_embeddings(path_fa, path_pt, pool, emb_layer, print_dims=True):
-    """ Read embeddings from pt files
+    """ Read embeddings from the feature store of path_pt when there is one,
+    otherwise from pt files
+
+    With a float32 feature store written in fasta order the embeddings are a
+    read-only np.memmap of it, nothing is loaded until it is used. float16 and
+    int8 stores are converted back to float32.
+
     Args:
         path_fa: path to fasta file 
         path_pt: path to pt files folder
@@ -160,6 +343,7 @@ def read_embeddings(path_fa, path_pt, pool, emb_layer, print_dims=True):
     ye = []
     Xe = []
     seq_id = []
+    headers = []
     
     # Read fasta headers and iterate through them
     for header, _seq in esm.data.read_fasta(path_fa):
@@ -170,14 +354,32 @@ def read_embeddings(path_fa, path_pt, pool, emb_layer, print_dims=True):
         # Below code is used due to existence of an additional "|" 
         # in the fasta header for dna_binding test dataset
         seq_id.append(header.split('|', 1)[-1][:-2])
-        # Embeddings are stored with the file name from fasta header
-        fn = f'{path_pt}/{header[1:]}.pt'
-        # Load the file
-        embs = torch.load(fn)
-        # Extract embedding tensor and append it to list
-        Xe.append(embs[f'{pool}_representations'][emb_layer])
-    # Concatenate embedding tensors from the list and convert to an array
-    Xe = torch.stack(Xe, dim=0).numpy()
+        headers.append(header[1:])
+
+    path_npy, path_ids, path_meta, path_scale = store_paths(path_pt)
+    if os.path.exists(path_meta):
+        # Map the feature store, the sidecar is written last so the store is complete
+        Xe = np.load(path_npy, mmap_mode='r')
+        with open(path_ids) as f:
+            rows = {key: i for i, key in enumerate(f.read().splitlines())}
+        order = np.array([rows[key] for key in headers], dtype=np.int64)
+        # Copy only when the rows are not already in fasta order
+        if len(order) != len(Xe) or np.any(order != np.arange(len(order))):
+            Xe = Xe[order]
+        if Xe.dtype == np.int8:
+            Xe = dequantize(Xe, np.load(path_scale)[order])
+        elif Xe.dtype != np.float32:
+            Xe = dequantize(Xe)
+    else:
+        for key in headers:
+            # Embeddings are stored with the file name from fasta header
+            fn = f'{path_pt}/{key}.pt'
+            # Load the file
+            embs = torch.load(fn)
+            # Extract embedding tensor and append it to list
+            Xe.append(embs[f'{pool}_representations'][emb_layer])
+        # Concatenate embedding tensors from the list and convert to an array
+        Xe = torch.stack(Xe, dim=0).numpy()
     
     if print_dims:
         print(f'Shape of embeddings: \t\t{Xe.shape}')
@@ -2,13 +2,16 @@
 #    get_emb_folders - prepare paths to embedding folders and fasta files for the given task
 #    fit_tune_CV - tune hyperparameters using GridSearchCV, fit and save models
 #    evaluation - evaluate models and store results into a dataframe
+#    precision_check - compare accuracy of models on float32 and reduced precision embeddings
 
 # Import dependencies
 import os
+import numpy as np
 import pandas as pd
 import joblib
 from sklearn.model_selection import GridSearchCV, StratifiedKFold
 from sklearn.metrics import accuracy_score, f1_score
+from file_utilities import quantize, dequantize
 random_state = 10
 
 # Function to prepare paths to embedding folders and fasta files for the given task
@@ -146,3 +149,44 @@ def evaluation(fit_models, X_test, y_test):
     eval_df.set_index('model', inplace = True)
     return eval_df
 
+# =============
+
+# Function to compare the accuracy of models on float32 and reduced precision embeddings
+def precision_check(fit_models, X_test, y_test, dtypes=('float16', 'int8')):
+    """ Compare accuracy of models on float32 and reduced precision embeddings
+
+    The test embeddings are stored in each dtype and read back, as a feature
+    store or embed_sequences.py --dtype would do, and the fitted models are
+    evaluated on them.
+
+    Args:
+        fit_models: dictionary of fitted models
+        X_test: test embedding vectors (float32)
+        y_test: test target variables
+        dtypes: storage precisions to check - ['float16', 'int8']
+
+    Returns:
+        check_df: accuracy and f1_macro per model and dtype, with the
+                  accuracy change versus float32
+    """
+    X_test = np.asarray(X_test, dtype=np.float32)
+    # Embeddings after a round trip through every storage precision
+    Xs = {'float32': X_test}
+    for dtype in dtypes:
+        Xs[dtype] = dequantize(*quantize(X_test, dtype))
+
+    lst = []
+    # Iterate through models in 'fit_models'
+    for name, model in fit_models.items():
+        base = None
+        for dtype, X in Xs.items():
+            y_pred = model.predict(X)
+            accuracy = accuracy_score(y_test, y_pred)
+            if base is None:
+                base = accuracy
+            lst.append([name, dtype, f1_score(y_test, y_pred, average='macro'),
+                        accuracy, accuracy - base])
+    # Create check dataframe
+    check_df = pd.DataFrame(lst, columns=['model', 'dtype', 'f1_macro', 'accuracy', 'accuracy_delta'])
+    check_df.set_index(['model', 'dtype'], inplace = True)
+    return check_df